@@ -1,13 +1,100 @@
+import asyncio
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+import hashlib
 from itertools import chain, combinations
-import tensorflow as tf
+import json
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import types
+import numpy as np
+
+
+# TensorFlow is only imported once a model is entered, so architecture definitions load quickly
+tf = None
+rewriter_config_pb2 = None
+Adafactor = None
+
+
+def import_tensorflow():
+    global tf, rewriter_config_pb2, Adafactor
+    if tf is None:
+        import tensorflow as tf
+        from tensorflow.core.protobuf import rewriter_config_pb2
+        Adafactor = define_adafactor()
+
+
+def import_times(repeats=5):
+    # average seconds to import this module in a fresh interpreter, with and without TensorFlow
+    import subprocess
+    import sys
+    directory = os.path.dirname(os.path.abspath(__file__))
+    statements = (('tf_macros', 'import tf_macros'), ('tensorflow', 'import tf_macros; tf_macros.import_tensorflow()'))
+    times = dict()
+    for name, statement in statements:
+        command = 'import time; start = time.perf_counter(); {}; print(time.perf_counter() - start)'.format(statement)
+        seconds = 0.0
+        for _ in range(repeats):
+            output = subprocess.check_output([sys.executable, '-c', command], cwd=directory)
+            seconds += float(output.decode().split()[-1])
+        times[name] = seconds / repeats
+    return times
+
+
+def data_format_times(batch_size=32, size=32, repeats=10):
+    # seconds per inference call of a convolutional and a residual network for each data format, or None if the
+    # format fails, see Model.benchmark_data_formats
+    data = {'image': np.random.uniform(size=(batch_size, size, size, 3))}
+    networks = (
+        ('ConvolutionalNet', (lambda: ConvolutionalNet(sizes=(16, 32, 64), depths=(2, 2, 2)))),
+        ('ResidualNet', (lambda: ResidualNet(sizes=(16, 32, 64), depths=(2, 2, 2))))
+    )
+    times = dict()
+    for name, network in networks:
+
+        def define():
+            x = Input(name='image', shape=(size, size, 3)) >> network() >> Reduction(reduction='mean', axis=(1, 2))
+            x = Dense(size=10)(inputs=(x,), output_key='logits')
+            x >> Classification(name='label', num_classes=10, sparse=True)
+
+        times[name] = Model.benchmark_data_formats(define=define, data=data, query='logits', repeats=repeats)
+    return times
+
+
+class Symbol(object):
+
+    def __init__(self, shape, dtype='float'):
+        shape = tuple(-1 if dims is None else dims for dims in shape)
+        assert all(isinstance(dims, int) and (dims > 0 or dims == -1) for dims in shape)
+        assert dtype in ('float', 'int', 'bool')
+        self.shape = shape
+        self.dtype = dtype
+
+
+def is_tensor(x):
+    return isinstance(x, Symbol) or is_tf_tensor(x)
+
+
+def is_tf_tensor(x):
+    return tf is not None and isinstance(x, tf.Tensor)
 
 
 def rank(x):
+    if isinstance(x, Symbol):
+        return len(x.shape)
     assert isinstance(x, tf.Tensor)
     return x.shape.ndims
 
 
 def shape(x):
+    if isinstance(x, Symbol):
+        return x.shape
     assert isinstance(x, tf.Tensor)
     return tuple(-1 if dims.value is None else dims.value for dims in x.shape.dims)
 
@@ -19,6 +106,131 @@ def product(xs):
     return prod
 
 
+def product_dims(dims):
+    dims = tuple(dims)
+    return -1 if -1 in dims else product(dims)
+
+
+def strided_dims(dims, window, stride, padding):
+    if dims == -1:
+        return -1
+    elif padding == 'SAME':
+        return (dims + stride - 1) // stride
+    else:
+        return (dims - window + stride) // stride
+
+
+# unknown dimensions, usually the batch, count as one, so statistics are per example
+def num_elements(x):
+    return product(max(dims, 1) for dims in shape(x))
+
+
+def num_bytes(x):
+    if isinstance(x, Symbol):
+        return num_elements(x) * Model.dtype(dtype=x.dtype, include_bytes=True)[1]
+    else:
+        return num_elements(x) * x.dtype.size
+
+
+# rank-4 image tensors follow the model data format, all other ranks are channels-last, as are all
+# tensors within a channels-last section, where inputs have been converted with to_channels_last
+def channels_first_format():
+    return Model.current.data_format == 'NCHW' and Model.current.channels_last_sections == 0
+
+
+def channels_first(x):
+    return rank(x) == 4 and channels_first_format()
+
+
+def data_format(x):
+    return 'NCHW' if channels_first(x) else 'NHWC'
+
+
+def channel_axis(x):
+    return 1 if channels_first(x) else rank(x) - 1
+
+
+def num_channels(x):
+    return shape(x)[channel_axis(x)]
+
+
+def channels_last_shape(x):
+    if channels_first(x):
+        return shape(x)[:1] + shape(x)[2:] + shape(x)[1:2]
+    else:
+        return shape(x)
+
+
+def data_format_shape(dims):
+    dims = tuple(dims)
+    if len(dims) == 4 and channels_first_format():
+        return dims[:1] + dims[3:] + dims[1:3]
+    else:
+        return dims
+
+
+def data_format_strides(x, stride):
+    if channels_first(x):
+        return (1, 1) + tuple(stride)
+    else:
+        return (1,) + tuple(stride) + (1,)
+
+
+def to_channels_last(x):
+    if not channels_first(x):
+        return x
+    elif isinstance(x, Symbol):
+        return Symbol(shape=channels_last_shape(x), dtype=x.dtype)
+    else:
+        return tf.transpose(a=x, perm=(0, 2, 3, 1))
+
+
+@contextmanager
+def channels_last_section():
+    Model.current.channels_last_sections += 1
+    try:
+        yield
+    finally:
+        Model.current.channels_last_sections -= 1
+
+
+def make_symbolic_template(name_, func_):
+    scope = Model.current.unique_scope(name=name_)
+
+    def template(*args):
+        Model.current.scopes.append(scope)
+        try:
+            return func_(*args)
+        finally:
+            Model.current.scopes.pop()
+
+    return template
+
+
+def graph_names(element):
+    if element is None:
+        return None
+    elif isinstance(element, dict):
+        return {key: graph_names(value) for key, value in element.items()}
+    elif isinstance(element, (list, tuple)):
+        return [graph_names(value) for value in element]
+    else:
+        return element.name
+
+
+def graph_elements(names, graph, variables):
+    if names is None:
+        return None
+    elif isinstance(names, dict):
+        return {key: graph_elements(value, graph, variables) for key, value in names.items()}
+    elif isinstance(names, list):
+        return [graph_elements(value, graph, variables) for value in names]
+    elif names in variables:
+        return variables[names]
+    else:
+        return graph.as_graph_element(obj=names)
+
+
 def make_least_common_shape(xs, ignore_ranks=()):
     assert len(xs) > 1
     shapes = [shape(x) for x in xs]
@@ -37,7 +249,7 @@ def make_least_common_shape(xs, ignore_ranks=()):
 
 def make_broadcastable(xs):
     assert len(xs) > 0
-    if len(xs) == 1 and not isinstance(xs[0], tf.Tensor):
+    if len(xs) == 1 and not is_tensor(xs[0]):
         xs = xs[0]
     shapes = [shape(x) for x in xs]
     ref_shape = max(shapes, key=(lambda s: len(s) - sum(dims == 1 for dims in s) / (len(s) + 1)))
@@ -58,16 +270,107 @@ def make_broadcastable(xs):
     return ys
 
 
-class Model(object):
+# Adafactor without momentum, https://arxiv.org/abs/1804.04235
+def define_adafactor():
+
+    class Adafactor(tf.train.Optimizer):
+
+        def __init__(self, learning_rate, decay_exponent=0.8, clipping_threshold=1.0, epsilon=1e-30, use_locking=False, name='Adafactor'):
+            super(Adafactor, self).__init__(use_locking=use_locking, name=name)
+            self.learning_rate = learning_rate
+            self.decay_exponent = decay_exponent
+            self.clipping_threshold = clipping_threshold
+            self.epsilon = epsilon
+            self.step = None
+
+        @staticmethod
+        def factored(var):
+            return var.shape.ndims >= 2
+
+        def _create_slots(self, var_list):
+            for var in var_list:
+                shape = var.shape.as_list()
+                if Adafactor.factored(var):
+                    # second moments of matrices are stored as row and column statistics
+                    self._get_or_make_slot(var=var, val=tf.zeros(shape=shape[:-1], dtype=var.dtype.base_dtype), slot_name='vr', op_name=self._name)
+                    self._get_or_make_slot(var=var, val=tf.zeros(shape=(shape[:-2] + shape[-1:]), dtype=var.dtype.base_dtype), slot_name='vc', op_name=self._name)
+                else:
+                    self._zeros_slot(var=var, slot_name='v', op_name=self._name)
+
+        def _prepare(self):
+            if self.step is None:
+                self.step = tf.Variable(initial_value=0.0, trainable=False, name=(self._name + '_step'))
+
+        def _apply_dense(self, grad, var):
+            step = self.step + 1.0
+            decay = 1.0 - tf.pow(x=step, y=-self.decay_exponent)
+            grad_squared = tf.square(x=grad) + self.epsilon
+            if Adafactor.factored(var):
+                vr = self.get_slot(var=var, name='vr')
+                vc = self.get_slot(var=var, name='vc')
+                next_vr = decay * vr + (1.0 - decay) * tf.reduce_mean(input_tensor=grad_squared, axis=-1)
+                next_vc = decay * vc + (1.0 - decay) * tf.reduce_mean(input_tensor=grad_squared, axis=-2)
+                row_factor = next_vr / tf.reduce_mean(input_tensor=next_vr, axis=-1, keep_dims=True)
+                v = tf.expand_dims(input=row_factor, axis=-1) * tf.expand_dims(input=next_vc, axis=-2)
+                updates = [tf.assign(ref=vr, value=next_vr, use_locking=self._use_locking), tf.assign(ref=vc, value=next_vc, use_locking=self._use_locking)]
+            else:
+                v = self.get_slot(var=var, name='v')
+                updates = [tf.assign(ref=v, value=(decay * v + (1.0 - decay) * grad_squared), use_locking=self._use_locking)]
+                v = updates[0]
+            update = grad * tf.rsqrt(x=v)
+            update /= tf.maximum(x=1.0, y=(tf.sqrt(x=tf.reduce_mean(input_tensor=tf.square(x=update))) / self.clipping_threshold))
+            updates.append(tf.assign_sub(ref=var, value=(self.learning_rate * update), use_locking=self._use_locking))
+            return tf.group(*updates)
+
+        def _apply_sparse(self, grad, var):
+            return self._apply_dense(grad=tf.convert_to_tensor(value=grad), var=var)
+
+        def _finish(self, update_ops, name_scope):
+            with tf.control_dependencies(control_inputs=update_ops):
+                update_step = tf.assign_add(ref=self.step, value=1.0, use_locking=self._use_locking)
+            return tf.group(*(list(update_ops) + [update_step]), name=name_scope)
+
+    return Adafactor
+
+
+class ModelType(type):
+
+    # the current model is tracked per thread, with models entered inside another model stacked on top
+    local = threading.local()
+
+    @property
+    def current(cls):
+        models = cls.active_models()
+        return models[-1] if len(models) > 0 else None
+
+    def active_models(cls):
+        if not hasattr(ModelType.local, 'models'):
+            ModelType.local.models = list()
+        return ModelType.local.models
+
+    def activate(cls, model):
+        assert model not in cls.active_models()
+        cls.active_models().append(model)
+
+    def deactivate(cls, model):
+        assert cls.current is model
+        cls.active_models().pop()
+
+
+class Model(object, metaclass=ModelType):
 
     precision = 32
-    current = None
+    # pruned weight matrices with at least this sparsity use sparse storage for inference
+    sparse_threshold = 0.5
 
     @staticmethod
     def dtype(dtype, include_bytes=False):
         assert Model.precision % 8 == 0
         assert dtype in ('float', 'int', 'bool')
-        if dtype == 'float':
+        if Model.current is not None and Model.current.dry_run:
+            # dry runs keep the dtype name and never touch TensorFlow
+            pass
+        elif dtype == 'float':
             if Model.precision == 32:
                 dtype = tf.float32
             else:
@@ -86,31 +389,122 @@ class Model(object):
         else:
             return dtype
 
-    def __init__(self, name=None, optimizer='adam', learning_rate=0.001, weight_decay=None, clip_gradients=None, model_directory=None, summary_directory=None):
+    @staticmethod
+    def valid_graph_rewrite(name):
+        return name in ('arithmetic_optimization', 'constant_folding', 'debug_stripper', 'dependency_optimization', 'function_optimization', 'layout_optimizer', 'loop_optimization', 'remapping', 'shape_optimization')
+
+    # counts of the forward graph, which is not built again for cached graphs
+    cached_statistics = ('num_parameters', 'num_bytes', 'num_pruned_parameters', 'num_pruned_bytes', 'num_flops', 'num_activation_bytes', 'output_names', 'pruning_sizes')
+
+    graph_attributes = ('training', 'dropout', 'optimization', 'summaries', 'tensors', 'placeholders', 'variables', 'metrics', 'metric_updates', 'metric_variables', 'bypasses', 'optimizer_variables', 'pruning', 'pruning_updates', 'pruning_counts', 'inference_refreshes')
+
+    def __new__(cls, *args, **kwargs):
+        model = super(Model, cls).__new__(cls)
+        model.specification = (args, kwargs)
+        return model
+
+    def __init__(self, name=None, optimizer='adam', learning_rate=0.001, weight_decay=None, decoupled_weight_decay=False, clip_gradients=None, clip_norm=None, model_directory=None, summary_directory=None, summary_frequency=1, summary_variables=None, summary_histograms=True, pruning_schedule=(0, 10000, 100), result_cache_size=None, result_cache_ttl=None, refresh_frequency=1000, cache_directory=None, dry_run=False, data_format='NHWC', intra_op_threads=None, inter_op_threads=None, per_session_threads=False, cpu_affinity=None, xla=False, graph_rewrites=None):
         assert name is None or isinstance(name, str)
-        assert optimizer in ('adam',)
+        assert optimizer in ('adafactor', 'adam', 'lazyadam', 'momentum', 'sgd')
         assert isinstance(learning_rate, float)
         assert weight_decay is None or isinstance(weight_decay, float)
+        assert isinstance(decoupled_weight_decay, bool) and (not decoupled_weight_decay or weight_decay is not None)
         assert clip_gradients is None or isinstance(clip_gradients, float)
+        assert clip_norm is None or (isinstance(clip_norm, float) and clip_norm > 0.0)
         assert model_directory is None or isinstance(model_directory, str)
         assert summary_directory is None or isinstance(summary_directory, str)
+        assert isinstance(summary_frequency, int) and summary_frequency > 0
+        assert summary_variables is None or all(isinstance(name, str) for name in summary_variables)
+        assert isinstance(summary_histograms, bool)
+        assert result_cache_size is None or (isinstance(result_cache_size, int) and result_cache_size > 0)
+        assert result_cache_ttl is None or (isinstance(result_cache_ttl, float) and result_cache_ttl > 0.0 and result_cache_size is not None)
+        assert isinstance(refresh_frequency, int) and refresh_frequency > 0
+        assert len(pruning_schedule) == 3 and all(isinstance(n, int) and n >= 0 for n in pruning_schedule) and pruning_schedule[0] < pruning_schedule[1] and pruning_schedule[2] > 0
+        assert cache_directory is None or isinstance(cache_directory, str)
+        assert isinstance(dry_run, bool) and not (dry_run and cache_directory is not None)
+        assert data_format in ('NHWC', 'NCHW')
+        assert intra_op_threads is None or (isinstance(intra_op_threads, int) and intra_op_threads > 0)
+        assert inter_op_threads is None or (isinstance(inter_op_threads, int) and inter_op_threads > 0)
+        assert isinstance(per_session_threads, bool)
+        assert cpu_affinity is None or (len(cpu_affinity) > 0 and all(isinstance(cpu, int) and cpu >= 0 for cpu in cpu_affinity))
+        assert isinstance(xla, bool)
+        assert graph_rewrites is None or all(Model.valid_graph_rewrite(name) and isinstance(enabled, bool) for name, enabled in graph_rewrites.items())
         self.name = name
         self.optimizer = optimizer
         self.learning_rate = learning_rate
         self.weight_decay = weight_decay
+        self.decoupled_weight_decay = decoupled_weight_decay
         self.clip_gradients = clip_gradients
+        self.clip_norm = clip_norm
         self.model_directory = model_directory
         self.summary_directory = summary_directory
+        self.summary_frequency = summary_frequency
+        self.summary_variables = None if summary_variables is None else tuple(summary_variables)
+        self.summary_histograms = summary_histograms
+        self.summary_writer = None
+        self.step = 0
+        self.pruning_schedule = tuple(pruning_schedule)
+        self.inference_refreshed = False
+        self.refresh_frequency = refresh_frequency
+        self.inference_calls = 0
+        self.result_cache_size = result_cache_size
+        self.result_cache_ttl = result_cache_ttl
+        self.result_cache = OrderedDict()
+        self.result_cache_lock = threading.Lock()
+        self.inference_lock = threading.Lock()
+        self.result_cache_generation = 0
+        self.result_cache_hits = 0
+        self.result_cache_misses = 0
+        self.cache_directory = cache_directory
+        self.dry_run = dry_run
+        self.data_format = data_format
+        self.channels_last_sections = 0
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.per_session_threads = per_session_threads
+        self.cpu_affinity = None if cpu_affinity is None else tuple(cpu_affinity)
+        self.xla = xla
+        self.graph_rewrites = graph_rewrites or dict()
         self.tensors = dict()
+        self.output_names = list()
         self.variables = dict()
         self.placeholders = dict()
+        self.metrics = dict()
+        self.metric_updates = list()
+        self.metric_variables = list()
+        self.bypasses = list()
+        self.optimizer_variables = list()
+        self.pruning_updates = list()
+        self.pruning_counts = list()
+        self.pruning_sizes = list()
+        self.inference_refreshes = list()
+        self.num_pruned_parameters = 0
+        self.num_pruned_bytes = 0
         self.num_parameters = 0
         self.num_bytes = 0
+        self.num_optimizer_bytes = 0
+        self.num_optimization_ops = 0
+        self.num_flops = 0
+        self.num_activation_bytes = 0
+        self.unit_statistics = dict()
+        self.construction_times = dict()
+        self.activations = set()
+        self.unit_totals = list()
+        self.unit_calls = list()
+        self.scopes = list()
+        self.scope_names = set()
+        self.opaque = False
+        self.described_functions = set()
+        self.unit_instances = dict()
+        self.unit_indices = Counter()
+        self.graph = None
+        self.graph_context = None
         self.scope = None
         self.session = None
         self.coordinator = None
         self.defined = False
         self.optimization = None
+        self.cached = False
 
     def __str__(self):
         if self.name is None:
@@ -123,6 +517,11 @@ class Model(object):
         assert key not in self.tensors
         self.tensors[key] = tensor
 
+    def register_output(self, key, tensor):
+        # tensors of unit calls with an output_key, the default outputs of exported models
+        self.register_tensor(key=key, tensor=tensor)
+        self.output_names.append(key)
+
     def register_variable(self, key, variable, num_parameters, num_bytes):
         if key in self.variables:
             assert variable == self.variables[key]
@@ -135,117 +534,561 @@ class Model(object):
         assert key not in self.placeholders
         self.placeholders[key] = placeholder
 
+    def register_metrics(self, metrics, update, variables):
+        assert all(key not in self.metrics for key in metrics)
+        self.metrics.update(metrics)
+        self.metric_updates.append(update)
+        self.metric_variables.extend(variables)
+
+    def register_bypass(self, output, input):
+        # output is equal to input at inference time, so inference_graph can skip the op
+        self.bypasses.append((output, input))
+
+    def register_refresh(self, refresh):
+        # rebuilds inference-only copies of variables, run before inference after training steps
+        self.inference_refreshes.append(refresh)
+
+    def register_pruning(self, update=None, refresh=None, count=None, size=None, num_parameters=0, num_bytes=0):
+        # dry runs pass the counts at the target sparsity, otherwise the mask count is used by count_pruned
+        if update is not None:
+            self.pruning_updates.append(update)
+        if refresh is not None:
+            self.register_refresh(refresh=refresh)
+        if count is not None:
+            self.pruning_counts.append(count)
+            self.pruning_sizes.append(size)
+        self.num_pruned_parameters += num_parameters
+        self.num_pruned_bytes += num_bytes
+        self.num_parameters -= num_parameters
+        self.num_bytes -= num_bytes
+
+    def enter_unit(self):
+        self.unit_totals.append([0, 0, 0.0])
+
+    def register_unit(self, unit, inputs, outputs, seconds=0.0):
+        total_flops, total_activation_bytes, nested_seconds = self.unit_totals.pop()
+        # construction time per unit type, own time excludes nested unit calls
+        unit_type = unit.__class__.customized[0] if 'customized' in unit.__class__.__dict__ else unit.__class__
+        times = self.construction_times.setdefault(unit_type.__name__, [0, 0.0, 0.0])
+        times[0] += 1
+        times[1] += seconds
+        times[2] += seconds - nested_seconds
+        if len(self.unit_totals) > 0:
+            self.unit_totals[-1][2] += seconds
+        else:
+            # top-level calls, replayed by NumpyEngine
+            self.unit_calls.append((unit, tuple(inputs), outputs))
+        if isinstance(unit, Variable):
+            return
+        outputs = (outputs,) if is_tensor(outputs) else outputs
+        num_flops = unit.num_flops(xs=tuple(inputs), ys=tuple(outputs))
+        num_activation_bytes = 0
+        # outputs passed through from a sub-unit are only counted once
+        for output in outputs:
+            if output not in self.activations:
+                self.activations.add(output)
+                num_activation_bytes += num_bytes(output)
+        total_flops += num_flops
+        total_activation_bytes += num_activation_bytes
+        # own numbers, and totals including all sub-units, e.g. the layers of a LayerStack
+        statistics = self.unit_statistics.setdefault(str(unit), [0, 0, 0, 0])
+        statistics[0] += num_flops
+        statistics[1] += num_activation_bytes
+        statistics[2] += total_flops
+        statistics[3] += total_activation_bytes
+        if len(self.unit_totals) > 0:
+            self.unit_totals[-1][0] += total_flops
+            self.unit_totals[-1][1] += total_activation_bytes
+        self.num_flops += num_flops
+        self.num_activation_bytes += num_activation_bytes
+
+    def statistics_table(self):
+        rows = [('unit', 'flops', 'activation bytes', 'total flops', 'total activation bytes')]
+        rows.extend((key,) + tuple(str(n) for n in statistics) for key, statistics in self.unit_statistics.items())
+        rows.append(('total', str(self.num_flops), str(self.num_activation_bytes), '', ''))
+        widths = [max(len(row[n]) for row in rows) for n in range(len(rows[0]))]
+        return '\n'.join('  '.join(cell.ljust(width) if n == 0 else cell.rjust(width) for n, (cell, width) in enumerate(zip(row, widths))) for row in rows)
+
+    def construction_table(self):
+        rows = [('unit type', 'calls', 'seconds', 'own seconds')]
+        ordered = sorted(self.construction_times.items(), key=(lambda item: -item[1][2]))
+        rows.extend((key, str(times[0]), '{:.4f}'.format(times[1]), '{:.4f}'.format(times[2])) for key, times in ordered)
+        # own times add up to the total construction time of all unit calls
+        own_seconds = sum(times[2] for times in self.construction_times.values())
+        rows.append(('total', str(sum(times[0] for times in self.construction_times.values())), '{:.4f}'.format(own_seconds), '{:.4f}'.format(own_seconds)))
+        widths = [max(len(row[n]) for row in rows) for n in range(len(rows[0]))]
+        return '\n'.join('  '.join(cell.ljust(width) if n == 0 else cell.rjust(width) for n, (cell, width) in enumerate(zip(row, widths))) for row in rows)
+
+    def unique_scope(self, name):
+        scope = self.scopes[-1] + '/' + name
+        if scope in self.scope_names:
+            n = 1
+            while '{}_{}'.format(scope, n) in self.scope_names:
+                n += 1
+            scope = '{}_{}'.format(scope, n)
+        self.scope_names.add(scope)
+        return scope
+
+    def next_unit_index(self, cls):
+        index = self.unit_indices[cls]
+        self.unit_indices[cls] += 1
+        return index
+
+    def unit_instance(self, unit):
+        if unit in self.unit_instances:
+            return self.unit_instances[unit]
+        if isinstance(unit, Composed):
+            # compositions have no name and are rebuilt from the instances of their parts
+            if isinstance(unit.first, Unit):
+                first = self.unit_instance(unit=unit.first)
+            else:
+                first = tuple(self.unit_instance(unit=x) if isinstance(x, Unit) else x for x in unit.first)
+            instance = Composed(first=first, second=self.unit_instance(unit=unit.second))
+        else:
+            cls, args, kwargs = unit.specification
+            if len(args) == 0 and 'name' not in kwargs:
+                kwargs = dict(kwargs, name=str(unit))
+            instance = cls(*args, **kwargs)
+        self.unit_instances[unit] = instance
+        return instance
+
+    def describe(self, value):
+        if isinstance(value, Unit):
+            # units defined outside the definition function, whose names are part of the graph
+            return ('unit', str(value)) + self.describe(value.specification)
+        elif isinstance(value, type):
+            if 'customized' in value.__dict__:
+                return ('customize',) + self.describe(value.customized)
+            return value.__module__ + '.' + value.__name__
+        elif isinstance(value, dict):
+            return tuple(sorted((key, self.describe(x)) for key, x in value.items()))
+        elif isinstance(value, (list, tuple)):
+            return tuple(self.describe(x) for x in value)
+        elif isinstance(value, np.ndarray):
+            # the array repr is abbreviated, so arrays are described by a digest of their values
+            value = np.ascontiguousarray(value)
+            return ('array', value.dtype.str, value.shape, hashlib.sha1(value.tobytes()).hexdigest())
+        elif hasattr(value, '__code__'):
+            # functions, including lambdas, are described by their code, defaults, closure values and used globals
+            if value in self.described_functions:
+                return ('function', value.__qualname__)
+            self.described_functions.add(value)
+            closure = tuple(cell.cell_contents for cell in (value.__closure__ or ()))
+            names = sorted(name for name in Model.code_names(code=value.__code__) if name in value.__globals__ and not isinstance(value.__globals__[name], types.ModuleType))
+            used_globals = tuple((name, self.describe(value.__globals__[name])) for name in names)
+            return ('function', value.__qualname__, self.describe_code(value.__code__), self.describe(value.__defaults__), self.describe(closure), used_globals)
+        elif callable(value) and hasattr(value, '__qualname__'):
+            return value.__module__ + '.' + value.__qualname__
+        else:
+            description = repr(value)
+            if ' at 0x' in description or is_tf_tensor(value):
+                # objects without a value repr cannot be compared across runs, so the graph is not cached
+                self.opaque = True
+            return description
+
+    def describe_code(self, code):
+        consts = tuple(self.describe_code(x) if hasattr(x, 'co_code') else repr(x) for x in code.co_consts)
+        return (hashlib.sha1(code.co_code).hexdigest(), consts, code.co_names)
+
+    @staticmethod
+    def code_names(code):
+        names = set(code.co_names)
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                names.update(Model.code_names(code=const))
+        return names
+
+    def definition_key(self, define):
+        # computed before the definition function builds anything, from the model arguments and the function
+        definition = (
+            Model.precision,
+            tf.__version__,
+            self.describe(self.specification),
+            self.describe(define)
+        )
+        if self.opaque:
+            return None
+        return hashlib.sha1(repr(definition).encode()).hexdigest()
+
+    def export_graph(self, path):
+        if not os.path.isdir(self.cache_directory):
+            os.makedirs(self.cache_directory)
+        tf.train.export_meta_graph(filename=(path + '.meta'))
+        elements = {attribute: graph_names(getattr(self, attribute, None)) for attribute in Model.graph_attributes}
+        statistics = {attribute: getattr(self, attribute) for attribute in Model.cached_statistics}
+        with open(path + '.json.tmp', 'w') as filehandle:
+            json.dump(obj=dict(elements=elements, statistics=statistics), fp=filehandle)
+        os.rename(path + '.json.tmp', path + '.json')
+
+    def import_graph(self, path):
+        with open(path + '.json', 'r') as filehandle:
+            cached = json.load(fp=filehandle)
+        # the cached graph replaces the one of the model internals
+        self.graph_context.__exit__(None, None, None)
+        self.enter_graph()
+        tf.train.import_meta_graph(meta_graph_or_file=(path + '.meta'))
+        variables = {variable.name: variable for variable in tf.global_variables() + tf.local_variables()}
+        for attribute, names in cached['elements'].items():
+            setattr(self, attribute, graph_elements(names, self.graph, variables))
+        for attribute, value in cached['statistics'].items():
+            setattr(self, attribute, value)
+        self.cached = True
+
+    def enter_graph(self):
+        # each model owns its graph, which is the default graph of the entering thread until exit
+        self.graph = tf.Graph()
+        self.graph_context = self.graph.as_default()
+        self.graph_context.__enter__()
+
+    def exit_graph(self):
+        self.graph_context.__exit__(None, None, None)
+        self.graph_context = None
+
     def __enter__(self):
-        tf.reset_default_graph()
-        assert Model.current is None
-        Model.current = self
+        if self.dry_run:
+            Model.activate(model=self)
+            self.scopes.append(str(self))
+            return self
+        import_tensorflow()
+        self.enter_graph()
+        Model.activate(model=self)
         self.scope = tf.variable_scope(str(self))
         self.scope.__enter__()
         Input(name='training', shape=(), dtype='bool', batched=False).forward()
         self.training = self.placeholders.pop('training')
         Input(name='dropout', shape=(), batched=False).forward()
         self.dropout = self.placeholders.pop('dropout')
+        Input(name='pruning', shape=(), batched=False).forward()
+        self.pruning = self.placeholders.pop('pruning')
         return self
 
     def __exit__(self, type, value, tb):
+        if self.dry_run:
+            Model.deactivate(model=self)
+            if type is not None:
+                raise
+            return
         if type is not None:
             if self.scope is not None:
                 self.scope.__exit__(None, None, None)
             if self.coordinator is not None:
                 self.coordinator.request_stop()
                 self.coordinator.join(threads=self.queue_threads)
+            self.close_summaries()
             if self.session is not None:
                 self.session.close()
-            Model.current = None
+            Model.deactivate(model=self)
+            self.exit_graph()
             raise
         if self.defined:
             self.coordinator.request_stop()
             self.coordinator.join(threads=self.queue_threads)
+            self.close_summaries()
             self.save()
             self.session.close()
         else:
-            if self.weight_decay is not None and self.weight_decay > 0.0:
-                for name, variable in self.variables.items():
-                    regularization = self.weight_decay * tf.nn.l2_loss(t=variable, name=(name + '-regularization'))
-                    tf.losses.add_loss(loss=regularization, loss_collection=tf.GraphKeys.REGULARIZATION_LOSSES)
-            loss = tf.losses.get_total_loss()
-            self.tensors['loss'] = loss
-            if self.optimizer == 'adam':
-                optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
-            try:
-                grads_and_vars = optimizer.compute_gradients(loss=loss)
-                if self.clip_gradients is not None:
-                    grads_and_vars = [(tf.clip_by_value(t=grad, clip_value_min=-self.clip_gradients, clip_value_max=self.clip_gradients), var) for grad, var in grads_and_vars]
-                self.optimization = optimizer.apply_gradients(grads_and_vars=grads_and_vars)
-            except ValueError as exc:
-                if str(exc) == 'No variables to optimize.':
-                    if self.optimization is None:
-                        self.optimization = tf.no_op()
-                else:
-                    raise exc
+            self.define_optimization()
             self.scope.__exit__(type, value, tb)
-        assert Model.current is not None
-        Model.current = None
+        Model.deactivate(model=self)
+        self.exit_graph()
 
-    def finalize(self, restore=False):
-        assert not self.defined
-        if self.weight_decay is not None and self.weight_decay > 0.0:
+    def define_optimization(self):
+        trainable_variables = set(tf.trainable_variables())
+        decay_variables = [variable for variable in self.variables.values() if variable in trainable_variables]
+        if self.weight_decay is not None and self.weight_decay > 0.0 and not self.decoupled_weight_decay:
             for name, variable in self.variables.items():
+                if variable not in trainable_variables:
+                    continue
                 regularization = self.weight_decay * tf.nn.l2_loss(t=variable, name=(name + '-regularization'))
                 tf.losses.add_loss(loss=regularization, loss_collection=tf.GraphKeys.REGULARIZATION_LOSSES)
         loss = tf.losses.get_total_loss()
         self.tensors['loss'] = loss
-        if self.optimizer == 'adam':
-            optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+        kwargs = dict(learning_rate=self.learning_rate)
+        if self.optimizer == 'adafactor':
+            optimizer = Adafactor
+        elif self.optimizer == 'adam':
+            optimizer = tf.train.AdamOptimizer
+        elif self.optimizer == 'lazyadam':
+            # only updates the moments of embedding rows which occur in the batch
+            optimizer = tf.contrib.opt.LazyAdamOptimizer
+        elif self.optimizer == 'momentum':
+            optimizer = tf.train.MomentumOptimizer
+            kwargs['momentum'] = 0.9
+        elif self.optimizer == 'sgd':
+            optimizer = tf.train.GradientDescentOptimizer
+        apply_kwargs = dict()
+        if self.decoupled_weight_decay:
+            # weight decay as part of the variable update, AdamW-style, instead of loss terms, scaled by the
+            # learning rate like the coupled decay, since the contrib optimizer applies it unscaled
+            optimizer = tf.contrib.opt.extend_with_decoupled_weight_decay(optimizer)
+            kwargs['weight_decay'] = self.weight_decay * self.learning_rate
+            apply_kwargs['decay_var_list'] = decay_variables
+        optimizer = optimizer(**kwargs)
         try:
             grads_and_vars = optimizer.compute_gradients(loss=loss)
             if self.clip_gradients is not None:
                 grads_and_vars = [(tf.clip_by_value(t=grad, clip_value_min=-self.clip_gradients, clip_value_max=self.clip_gradients), var) for grad, var in grads_and_vars]
-            self.optimization = optimizer.apply_gradients(grads_and_vars=grads_and_vars)
+            if self.clip_norm is not None:
+                # one global norm reduction over all gradients
+                grads, variables = zip(*grads_and_vars)
+                grads, _ = tf.clip_by_global_norm(t_list=grads, clip_norm=self.clip_norm)
+                grads_and_vars = list(zip(grads, variables))
+            # slots and other optimizer state are the variables created by apply_gradients
+            variables = set(tf.global_variables())
+            self.optimization = optimizer.apply_gradients(grads_and_vars=grads_and_vars, **apply_kwargs)
+            self.optimizer_variables = [variable for variable in tf.global_variables() if variable not in variables]
         except ValueError as exc:
             if str(exc) == 'No variables to optimize.':
                 if self.optimization is None:
                     self.optimization = tf.no_op()
             else:
                 raise exc
-        global_variables_initializer = tf.global_variables_initializer()
-        if self.model_directory is not None:
-            self.saver = tf.train.Saver()
-        if self.summary_directory is not None:
-            tf.summary.scalar(name='loss', tensor=loss)
-            for variable in tf.trainable_variables():
-                tf.summary.histogram(name=variable.name, values=variable)
-            self.summaries = tf.summary.merge_all()
-        self.scope.__exit__(None, None, None)
-        self.scope = None
-        tf.get_default_graph().finalize()
+
+    def finalize(self, restore=False, define=None):
+        assert not self.defined and not self.dry_run
+        # cached graphs are keyed on a function which defines the model, so that it is not called on a hit
+        assert self.cache_directory is None or define is not None
+        key = None if self.cache_directory is None else self.definition_key(define=define)
+        cache_path = None if key is None else os.path.join(self.cache_directory, key)
+        if cache_path is not None and os.path.isfile(cache_path + '.json'):
+            # identical definition already built: import the cached graph instead of constructing it,
+            # so no unit holds tensors of this model
+            self.scope.__exit__(None, None, None)
+            self.scope = None
+            self.import_graph(path=cache_path)
+        else:
+            if define is not None:
+                define()
+            self.define_optimization()
+            if self.summary_directory is not None:
+                summaries = [tf.summary.scalar(name='loss', tensor=self.tensors['loss'])]
+                # metrics of the training batch, since streaming metrics are only updated by evaluate
+                for name in self.metrics:
+                    if name in self.tensors:
+                        summaries.append(tf.summary.scalar(name=name, tensor=self.tensors[name]))
+                # histograms are comparatively expensive, so they can be restricted or switched off
+                if self.summary_histograms:
+                    for variable in tf.trainable_variables():
+                        if self.summary_variables is None or any(name in variable.name for name in self.summary_variables):
+                            summaries.append(tf.summary.histogram(name=variable.name, values=variable))
+                self.summaries = tf.summary.merge(inputs=summaries)
+            self.scope.__exit__(None, None, None)
+            self.scope = None
+            if cache_path is not None:
+                self.export_graph(path=cache_path)
+        # ops executed per optimization step, including the forward and backward pass
+        graph_def = self.graph.as_graph_def()
+        self.num_optimization_ops = len(tf.graph_util.extract_sub_graph(graph_def=graph_def, dest_nodes=[self.optimization.name]).node)
+        self.num_optimizer_bytes = sum(variable.shape.num_elements() * variable.dtype.base_dtype.size for variable in self.optimizer_variables)
+        self.initializer = tf.global_variables_initializer()
+        self.metric_reset = tf.variables_initializer(var_list=self.metric_variables)
+        # the saver is also used by autotune to move variable values to a new session
+        self.saver = tf.train.Saver() if len(tf.global_variables()) > 0 else None
+        self.graph.finalize()
         self.defined = True
 
-        self.session = tf.Session()
+        self.session = self.create_session()
         if restore:
             assert self.model_directory
             # save_path = tf.train.latest_checkpoint(checkpoint_dir=self.model_directory)
             self.saver.restore(sess=self.session, save_path=(self.model_directory + 'model'))
         else:
-            self.session.run(fetches=global_variables_initializer)
+            self.session.run(fetches=self.initializer)
+        self.session.run(fetches=self.metric_reset)
+        self.inference_refreshed = False
+        self.invalidate_result_cache()
+        self.count_pruned()
         if self.summary_directory is not None:
+            # the writer writes events from its own background thread
             self.summary_writer = tf.summary.FileWriter(logdir=self.summary_directory, graph=self.session.graph)
         self.coordinator = tf.train.Coordinator()
         self.queue_threads = tf.train.start_queue_runners(sess=self.session, coord=self.coordinator)
 
+    def create_session(self, **settings):
+        for name in settings:
+            assert name in ('intra_op_threads', 'inter_op_threads', 'per_session_threads', 'cpu_affinity', 'xla', 'graph_rewrites')
+        intra_op_threads = settings.get('intra_op_threads', self.intra_op_threads)
+        inter_op_threads = settings.get('inter_op_threads', self.inter_op_threads)
+        per_session_threads = settings.get('per_session_threads', self.per_session_threads)
+        cpu_affinity = settings.get('cpu_affinity', self.cpu_affinity)
+        xla = settings.get('xla', self.xla)
+        graph_rewrites = settings.get('graph_rewrites', self.graph_rewrites)
+        if cpu_affinity is not None:
+            # affinity is set for the calling thread and inherited by the threads it starts afterwards, like the thread
+            # pools of a new session, but not by existing ones, and it is not per model: later settings replace it
+            os.sched_setaffinity(0, cpu_affinity)
+        config = tf.ConfigProto()
+        # by default sessions share the process-wide thread pools, which keep the settings of the first session,
+        # per-session pools make the settings take effect at the cost of more threads
+        config.use_per_session_threads = per_session_threads
+        if intra_op_threads is not None:
+            config.intra_op_parallelism_threads = intra_op_threads
+        if inter_op_threads is not None:
+            config.inter_op_parallelism_threads = inter_op_threads
+        if xla:
+            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        rewrite_options = config.graph_options.rewrite_options
+        for name, enabled in graph_rewrites.items():
+            setattr(rewrite_options, name, rewriter_config_pb2.RewriterConfig.ON if enabled else rewriter_config_pb2.RewriterConfig.OFF)
+        return tf.Session(graph=self.graph, config=config)
+
+    def autotune(self, data, query, candidates=None, repeats=10):
+        assert self.defined and self.saver is not None
+        assert isinstance(repeats, int) and repeats > 0
+        if candidates is None:
+            num_cpus = os.cpu_count() or 1
+            candidates = [dict(intra_op_threads=intra, inter_op_threads=inter) for intra in sorted({1, max(num_cpus // 2, 1), num_cpus}) for inter in (1, 2)]
+        if isinstance(query, str):
+            fetches = self.tensors[query]
+        else:
+            fetches = [self.tensors[name] for name in query]
+        feed_dict = self.get_feed_dict(data=data)
+        timings = list()
+        # candidate affinities replace the one of the calling thread, so the original one is restored afterwards
+        affinity = os.sched_getaffinity(0)
+        try:
+            for settings in candidates:
+                # variable values do not matter for timing, so candidates are just initialized,
+                # with their own thread pools since the shared ones ignore their thread settings
+                session = self.create_session(**dict(settings, per_session_threads=True))
+                try:
+                    session.run(fetches=(self.initializer, self.metric_reset))
+                    session.run(fetches=fetches, feed_dict=feed_dict)
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        session.run(fetches=fetches, feed_dict=feed_dict)
+                    timings.append(((time.perf_counter() - start) / repeats, settings))
+                finally:
+                    session.close()
+        finally:
+            os.sched_setaffinity(0, affinity)
+        _, best = min(timings, key=(lambda timing: timing[0]))
+        # switch the model session to the fastest settings, keeping variable values but resetting metrics,
+        # thread settings only take effect with per-session threads or if no other session created the shared pools
+        directory = tempfile.mkdtemp()
+        try:
+            save_path = self.saver.save(sess=self.session, save_path=os.path.join(directory, 'model'))
+            self.coordinator.request_stop()
+            self.coordinator.join(threads=self.queue_threads)
+            self.session.close()
+            for name, value in best.items():
+                setattr(self, name, value)
+            self.session = self.create_session()
+            self.saver.restore(sess=self.session, save_path=save_path)
+        finally:
+            shutil.rmtree(directory)
+        self.session.run(fetches=self.metric_reset)
+        self.inference_refreshed = False
+        self.invalidate_result_cache()
+        self.coordinator = tf.train.Coordinator()
+        self.queue_threads = tf.train.start_queue_runners(sess=self.session, coord=self.coordinator)
+        return best, timings
+
+    @staticmethod
+    def benchmark_data_formats(define, data, query, repeats=10, **kwargs):
+        # seconds per inference call of the model built by define() for each data format, or None if the format fails,
+        # since stock TensorFlow CPU kernels for convolution, pooling and fused batch normalization only accept NHWC
+        assert isinstance(repeats, int) and repeats > 0
+        assert 'data_format' not in kwargs and kwargs.get('result_cache_size') is None
+        timings = dict()
+        for data_format in ('NHWC', 'NCHW'):
+            with Model(data_format=data_format, **kwargs) as model:
+                model.finalize(define=define)
+                try:
+                    model(query=query, data=data)
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        model(query=query, data=data)
+                    timings[data_format] = (time.perf_counter() - start) / repeats
+                except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError):
+                    timings[data_format] = None
+        return timings
+
+    def close_summaries(self):
+        if self.summary_writer is not None:
+            self.summary_writer.close()
+            self.summary_writer = None
+
     def save(self):
         assert self.defined
-        if self.model_directory:
+        if self.model_directory and self.saver is not None:
             self.saver.save(sess=self.session, save_path=(self.model_directory + 'model'))
 
-    def __call__(self, query=None, data=None, optimize=False, summarize=False, dropout=None):
-        assert self.session
-        if query is None:
-            fetches = dict()
-        elif isinstance(query, str):
-            fetches = dict(query=self.tensors[query])
+    def prune(self, fraction=1.0):
+        # fraction of the target sparsity of each pruned layer
+        assert isinstance(fraction, float) and 0.0 <= fraction <= 1.0
+        self.session.run(fetches=self.pruning_updates, feed_dict={self.pruning: fraction})
+        self.inference_refreshed = False
+        self.invalidate_result_cache()
+        self.count_pruned()
+
+    def count_pruned(self):
+        # parameter and byte counts follow the current density of the pruning masks
+        num_parameters = num_bytes = 0
+        for (num_weights, capacity, dtype_bytes), num_kept in zip(self.pruning_sizes, self.session.run(fetches=self.pruning_counts)):
+            counts = Pruning.pruned_counts(num_weights=num_weights, num_kept=num_kept, capacity=capacity, dtype_bytes=dtype_bytes)
+            num_parameters += counts[0]
+            num_bytes += counts[1]
+        self.num_parameters += self.num_pruned_parameters - num_parameters
+        self.num_bytes += self.num_pruned_bytes - num_bytes
+        self.num_pruned_parameters = num_parameters
+        self.num_pruned_bytes = num_bytes
+
+    def refresh_inference(self):
+        # inference copies, like sparse weights or hot embeddings, are rebuilt once after training steps,
+        # and every refresh_frequency inference calls to follow usage statistics
+        with self.inference_lock:
+            self.inference_calls += 1
+            if not self.inference_refreshed or self.inference_calls % self.refresh_frequency == 0:
+                self.session.run(fetches=self.inference_refreshes)
+                self.inference_refreshed = True
+
+    def profile(self, query, data=None):
+        # op execution time in microseconds per top-level unit, from a traced run
+        if isinstance(query, str):
+            fetches = self.tensors[query]
         else:
-            fetches = {name: self.tensors[name] for name in query}
+            fetches = [self.tensors[name] for name in query]
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        self.session.run(fetches=fetches, feed_dict=self.get_feed_dict(data=data), options=run_options, run_metadata=run_metadata)
+        times = Counter()
+        for device_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in device_stats.node_stats:
+                names = node_stats.node_name.split('/')
+                times[names[1] if len(names) > 2 and names[0] == str(self) else names[0]] += node_stats.all_end_rel_micros
+        return dict(times)
+
+    def result_cache_key(self, query, data):
+        digest = hashlib.blake2b(repr(query).encode(), digest_size=16)
+        if not isinstance(data, dict):
+            data = {None: data}
+        for name in sorted(data, key=str):
+            value = np.ascontiguousarray(data[name])
+            digest.update(repr((name, value.dtype.str, value.shape)).encode())
+            digest.update(value.tobytes())
+        return digest.digest()
+
+    def invalidate_result_cache(self):
+        with self.result_cache_lock:
+            self.result_cache.clear()
+            # results of calls still running when the cache is invalidated are not inserted
+            self.result_cache_generation += 1
+
+    @staticmethod
+    def copy_result(fetched):
+        # cached arrays are never shared with callers, which may modify their results in place
+        return {name: (value.copy() if isinstance(value, np.ndarray) else value) for name, value in fetched.items()}
+
+    def result_cache_statistics(self):
+        with self.result_cache_lock:
+            requests = self.result_cache_hits + self.result_cache_misses
+            hit_rate = self.result_cache_hits / requests if requests > 0 else 0.0
+            return dict(hits=self.result_cache_hits, misses=self.result_cache_misses, hit_rate=hit_rate, size=len(self.result_cache))
+
+    def get_feed_dict(self, data=None, optimize=False, dropout=None):
+        if not optimize and len(self.inference_refreshes) > 0:
+            self.refresh_inference()
         if data is None:
             feed_dict = dict()
         elif isinstance(data, dict):
@@ -253,49 +1096,745 @@ class Model(object):
         else:
             assert len(self.placeholders) == 1
             feed_dict = {next(iter(self.placeholders.values())): data}
-        if optimize:
-            feed_dict[self.training] = True
-            assert 'optimization' not in fetches
-            fetches['optimization'] = self.optimization
-        else:
-            feed_dict[self.training] = False
-        if self.summary_directory is not None and summarize:
-            assert 'summaries' not in fetches
-            fetches['summaries'] = self.summaries
+        feed_dict[self.training] = bool(optimize)
         assert dropout is None or 0.0 <= dropout < 1.0
         if dropout is None:
             feed_dict[self.dropout] = 0.0
         else:
             feed_dict[self.dropout] = dropout
+        return feed_dict
+
+    def __call__(self, query=None, data=None, optimize=False, summarize=False, dropout=None):
+        assert self.session
+        # only deterministic inference on explicit data is cached
+        cached = self.result_cache_size is not None and data is not None and not optimize and not summarize and not dropout
+        if cached:
+            key = self.result_cache_key(query=query, data=data)
+            with self.result_cache_lock:
+                if key in self.result_cache:
+                    timestamp, fetched = self.result_cache[key]
+                    if self.result_cache_ttl is None or time.time() - timestamp < self.result_cache_ttl:
+                        self.result_cache.move_to_end(key)
+                        self.result_cache_hits += 1
+                        return Model.copy_result(fetched=fetched)
+                    del self.result_cache[key]
+                self.result_cache_misses += 1
+                generation = self.result_cache_generation
+        if query is None:
+            fetches = dict()
+        elif isinstance(query, str):
+            fetches = dict(query=self.tensors[query])
+        else:
+            fetches = {name: self.tensors[name] for name in query}
+        feed_dict = self.get_feed_dict(data=data, optimize=optimize, dropout=dropout)
+        if optimize:
+            assert 'optimization' not in fetches
+            fetches['optimization'] = self.optimization
+        # summaries are only computed every summary_frequency steps
+        summarize = self.summary_directory is not None and summarize and self.step % self.summary_frequency == 0
+        if summarize:
+            assert 'summaries' not in fetches
+            fetches['summaries'] = self.summaries
         fetched = self.session.run(fetches=fetches, feed_dict=feed_dict)
         if optimize:
             fetched.pop('optimization')
-        if self.summary_directory is not None and summarize:
-            fetched.pop('summaries')
+        if summarize:
+            self.summary_writer.add_summary(summary=fetched.pop('summaries'), global_step=self.step)
+        if cached:
+            with self.result_cache_lock:
+                if generation == self.result_cache_generation:
+                    self.result_cache[key] = (time.time(), Model.copy_result(fetched=fetched))
+                    while len(self.result_cache) > self.result_cache_size:
+                        self.result_cache.popitem(last=False)
+        if optimize:
+            self.step += 1
+            self.inference_refreshed = False
+            self.invalidate_result_cache()
+            begin, end, frequency = self.pruning_schedule
+            if len(self.pruning_updates) > 0 and begin <= self.step <= end and (self.step - begin) % frequency == 0:
+                # polynomial schedule, https://arxiv.org/abs/1710.01878
+                self.prune(fraction=(1.0 - (1.0 - float(self.step - begin) / (end - begin)) ** 3))
+        return fetched
+
+    def inference_graph(self, outputs=None):
+        assert self.defined
+        if outputs is None:
+            outputs = [name for name in self.tensors if name != 'loss']
+        output_names = [self.tensors[name].op.name for name in outputs]
+        graph_def = self.session.graph.as_graph_def()
+        num_nodes = len(graph_def.node)
+        graph_def = tf.graph_util.convert_variables_to_constants(sess=self.session, input_graph_def=graph_def, variable_names_whitelist=None, output_node_names=output_names)
+        # training and dropout become constants with their inference values
+        constants = {self.training.op.name: False, self.dropout.op.name: 0.0}
+        for node in graph_def.node:
+            if node.name in constants:
+                node.op = 'Const'
+                del node.attr['shape']
+                node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(values=constants[node.name], dtype=node.attr['dtype'].type))
+        bypasses = dict()
+        for output, input in self.bypasses:
+            name = input.op.name if input.value_index == 0 else input.name
+            bypasses[output.op.name] = bypasses[output.name] = name
+        # conditionals on the constant training flag reduce to their inference branch,
+        # switches, including those of variables used in a branch, forward their input and merges the output
+        # of the false branch
+        nodes = {node.name: node for node in graph_def.node}
+        conditionals = set()
+        for node in graph_def.node:
+            if node.op in ('Switch', 'RefSwitch'):
+                predicate = node.input[1].split(':')[0]
+                while nodes[predicate].op == 'Identity':
+                    predicate = nodes[predicate].input[0].split(':')[0]
+                if predicate == self.training.op.name:
+                    bypasses[node.name] = bypasses[node.name + ':1'] = node.input[0]
+                    conditionals.add(node.name.rsplit('/', 1)[0])
+        for node in graph_def.node:
+            if node.op == 'Merge' and node.name.rsplit('/', 1)[0] in conditionals:
+                bypasses[node.name] = node.input[0]
+        updates = {node.name for node in graph_def.node if node.op in ('Assign', 'AssignAdd', 'AssignSub', 'ScatterAdd', 'ScatterUpdate')}
+        for node in graph_def.node:
+            inputs = list()
+            for name in node.input:
+                control = name.startswith('^')
+                name = name[1:] if control else name
+                while name in bypasses:
+                    name = bypasses[name]
+                if control and name.split(':')[0] in updates:
+                    # statistics updates, like those of hot embeddings, are not part of inference
+                    continue
+                inputs.append('^' + name.split(':')[0] if control else name)
+            del node.input[:]
+            node.input.extend(inputs)
+        graph_def = tf.graph_util.remove_training_nodes(input_graph=graph_def, protected_nodes=output_names)
+        for node in graph_def.node:
+            # colocation constraints do not matter for inference, and may name identities removed above
+            if '_class' in node.attr:
+                del node.attr['_class']
+        graph_def = tf.graph_util.extract_sub_graph(graph_def=graph_def, dest_nodes=output_names)
+        return graph_def, num_nodes, len(graph_def.node)
+
+    def export_inference_graph(self, path, outputs=None):
+        graph_def, num_nodes, num_inference_nodes = self.inference_graph(outputs=outputs)
+        directory, filename = os.path.split(path)
+        tf.train.write_graph(graph_or_graph_def=graph_def, logdir=(directory or '.'), name=filename, as_text=False)
+        return num_nodes, num_inference_nodes
+
+    def export_onnx(self, path, outputs=None, opset=None):
+        # optional dependency, only required for the export
+        from tf2onnx import optimizer, tfonnx
+        if outputs is None:
+            outputs = self.output_names
+        graph_def, _, _ = self.inference_graph(outputs=outputs)
+        node_names = {node.name for node in graph_def.node}
+        input_names = [placeholder.name for placeholder in self.placeholders.values() if placeholder.op.name in node_names]
+        output_names = [self.tensors[name].name for name in outputs]
+        with tf.Graph().as_default() as graph:
+            tf.import_graph_def(graph_def=graph_def, name='')
+            onnx_graph = tfonnx.process_tf_graph(tf_graph=graph, opset=opset, input_names=input_names, output_names=output_names)
+        onnx_graph = optimizer.optimize_graph(graph=onnx_graph)
+        model_proto = onnx_graph.make_model(graph_doc=str(self))
+        with open(path, 'wb') as filehandle:
+            filehandle.write(model_proto.SerializeToString())
+        return input_names, output_names
+
+    def validate_onnx(self, path, data, outputs=None):
+        # maximum absolute difference of the exported model outputs, run with onnxruntime, to the session outputs
+        import onnxruntime
+        if outputs is None:
+            outputs = self.output_names
+        if not isinstance(data, dict):
+            assert len(self.placeholders) == 1
+            data = {next(iter(self.placeholders)): data}
+        session = onnxruntime.InferenceSession(path)
+        keys = {placeholder.name: key for key, placeholder in self.placeholders.items()}
+        input_feed = dict()
+        for x in session.get_inputs():
+            key = keys[x.name]
+            input_feed[x.name] = np.asarray(data[key], dtype=self.placeholders[key].dtype.as_numpy_dtype)
+        fetched = session.run(output_names=[self.tensors[name].name for name in outputs], input_feed=input_feed)
+        expected = self(query=outputs, data=data)
+        return {name: float(np.max(np.abs(np.asarray(expected[name], dtype=np.float64) - value), initial=0.0)) for name, value in zip(outputs, fetched)}
+
+    def evaluate(self, dataset):
+        assert self.session
+        # streaming metrics change, so cached queries of them become stale
+        self.invalidate_result_cache()
+        self.session.run(fetches=self.metric_reset)
+        for data in dataset:
+            self.session.run(fetches=self.metric_updates, feed_dict=self.get_feed_dict(data=data))
+        return self.session.run(fetches=self.metrics)
+
+
+class Server(object):
+
+    def __init__(self, model, query, max_batch_size=32, max_latency=0.005):
+        assert model.defined
+        assert isinstance(query, str) or all(isinstance(name, str) for name in query)
+        assert isinstance(max_batch_size, int) and max_batch_size > 0
+        assert isinstance(max_latency, float) and max_latency >= 0.0
+        self.model = model
+        if isinstance(query, str):
+            self.fetches = {query: model.tensors[query]}
+        else:
+            self.fetches = {name: model.tensors[name] for name in query}
+        # outputs with an unknown leading dimension are sliced per request, others, like aggregate metrics, are shared
+        self.batched = {name: rank(tensor) > 0 and shape(tensor)[0] == -1 for name, tensor in self.fetches.items()}
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        # requests which do not fit into a micro-batch start the next one
+        self.pending = None
+        # all requests feed the same inputs, fixed by the first request
+        self.names = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def submit(self, data):
+        # data maps input names to arrays with a leading batch dimension, like Model.__call__
+        if not isinstance(data, dict):
+            assert len(self.model.placeholders) == 1
+            data = {next(iter(self.model.placeholders)): data}
+        assert all(name in self.model.placeholders for name in data)
+        data = {name: np.asarray(value) for name, value in data.items()}
+        batch_size = len(next(iter(data.values())))
+        assert all(len(value) == batch_size for value in data.values())
+        assert batch_size <= self.max_batch_size, 'request larger than the maximum batch size'
+        future = Future()
+        with self.lock:
+            assert not self.closed, 'server is closed'
+            if self.names is None:
+                self.names = frozenset(data)
+            assert frozenset(data) == self.names, 'requests have to feed the same inputs'
+            self.requests.put((data, batch_size, future))
+        return future
+
+    def submit_async(self, data):
+        return asyncio.wrap_future(future=self.submit(data=data))
+
+    def __call__(self, data):
+        return self.submit(data=data).result()
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def statistics(self):
+        with self.lock:
+            return dict(batch_sizes=dict(self.batch_sizes), queue_depths=dict(self.queue_depths))
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.requests.put(None)
+        self.thread.join()
+
+    def next_request(self, deadline=None):
+        # requests cancelled by the caller are dropped, the others can no longer be cancelled
+        while True:
+            if deadline is None:
+                request = self.requests.get()
+            else:
+                timeout = deadline - time.perf_counter()
+                request = self.requests.get(timeout=timeout) if timeout > 0.0 else self.requests.get_nowait()
+            if request is None or request[2].set_running_or_notify_cancel():
+                return request
+
+    def collect(self):
+        if self.pending is not None:
+            request = self.pending
+            self.pending = None
+        else:
+            request = self.next_request()
+            if request is None:
+                return None
+        requests = [request]
+        batch_size = request[1]
+        deadline = time.perf_counter() + self.max_latency
+        while batch_size < self.max_batch_size:
+            try:
+                request = self.next_request(deadline=deadline)
+            except queue.Empty:
+                break
+            if request is None:
+                # serve what was collected, then stop
+                self.requests.put(None)
+                break
+            if batch_size + request[1] > self.max_batch_size:
+                self.pending = request
+                break
+            requests.append(request)
+            batch_size += request[1]
+        with self.lock:
+            self.batch_sizes[batch_size] += 1
+            self.queue_depths[self.requests.qsize()] += 1
+        return requests
+
+    def serve(self):
+        while True:
+            requests = self.collect()
+            if requests is None:
+                return
+            try:
+                data = {name: np.concatenate([data[name] for data, _, _ in requests], axis=0) for name in self.names}
+                fetched = self.model.session.run(fetches=self.fetches, feed_dict=self.model.get_feed_dict(data=data))
+            except Exception as exc:
+                for _, _, future in requests:
+                    future.set_exception(exc)
+                continue
+            offset = 0
+            for _, batch_size, future in requests:
+                try:
+                    future.set_result({name: (value[offset:offset + batch_size] if self.batched[name] else value) for name, value in fetched.items()})
+                except Exception as exc:
+                    future.set_exception(exc)
+                offset += batch_size
+
+
+class NumpyEngine(object):
+
+    def __init__(self, model):
+        assert model.defined and not model.dry_run and not model.cached
+        # top-level unit calls are compiled to steps of NumPy functions, with weights copied from the session,
+        # so the engine has to be rebuilt after further training
+        self.model = model
+        self.steps = list()
+        self.inputs = dict()
+        self.outputs = dict()
+        self.transposed = set()
+        self.schedules = dict()
+        self.num_slots = 0
+        self.slots = dict()
+        self.values = dict()
+        self.occurrences = Counter()
+        for unit, inputs, outputs in model.unit_calls:
+            ys = self.call(unit=unit, xs=tuple(self.slot(x=x) for x in inputs))
+            if is_tensor(outputs):
+                self.slots[outputs] = ys
+            else:
+                ys = (ys,) if len(outputs) == 1 else ys
+                self.slots.update(zip(outputs, ys))
+        for name, tensor in model.tensors.items():
+            if self.slots.get(tensor) is not None:
+                self.register(key=name, slot=self.slots[tensor])
+                # outputs are computed channels-last
+                if rank(tensor) == 4 and model.data_format == 'NCHW':
+                    self.transposed.add(name)
+        self.slots = None
+        self.values = None
+        self.occurrences = None
+
+    @staticmethod
+    def load(path):
+        engine = NumpyEngine.__new__(NumpyEngine)
+        engine.model = None
+        with open(path, 'rb') as filehandle:
+            engine.steps, engine.inputs, engine.outputs, engine.transposed = pickle.load(file=filehandle)
+        engine.schedules = dict()
+        return engine
+
+    def save(self, path):
+        with open(path, 'wb') as filehandle:
+            pickle.dump(obj=(self.steps, self.inputs, self.outputs, self.transposed), file=filehandle)
+
+    def slot(self, x):
+        assert x in self.slots, 'tensor {} not computed by a unit'.format(x.name)
+        return self.slots[x]
+
+    def call(self, unit, xs):
+        xs = xs if isinstance(xs, tuple) else (xs,)
+        ys = unit.compile_numpy(self, *xs)
+        if isinstance(ys, tuple) and len(ys) == 1:
+            return ys[0]
+        return ys
+
+    def add(self, op, *xs, num_out=1, **arguments):
+        ys = tuple(range(self.num_slots, self.num_slots + num_out))
+        self.num_slots += num_out
+        self.steps.append((op, arguments, xs, ys))
+        return ys[0] if num_out == 1 else ys
+
+    def input(self, name):
+        if name not in self.model.placeholders:
+            return None
+        if name not in self.inputs:
+            placeholder = self.model.placeholders[name]
+            self.inputs[name] = (self.num_slots, np.dtype(placeholder.dtype.as_numpy_dtype))
+            self.num_slots += 1
+        return self.inputs[name][0]
+
+    def register(self, key, slot):
+        self.outputs[key] = slot
+
+    def value(self, variable):
+        if isinstance(variable, Variable):
+            variable = variable.variable
+        if variable.name not in self.values:
+            self.values[variable.name] = self.model.session.run(fetches=variable)
+        return self.values[variable.name]
+
+    def channels_last(self, value):
+        if value.ndim == 4 and self.model.data_format == 'NCHW':
+            return np.transpose(value, (0, 2, 3, 1))
+        return value
+
+    def occurrence(self, unit):
+        # number of previous calls of the unit, in the order of model definition
+        n = self.occurrences[unit]
+        self.occurrences[unit] += 1
+        return n
+
+    def schedule(self, names):
+        # only the steps required for the queried outputs, and the input slots they read
+        if names not in self.schedules:
+            required = {self.outputs[name] for name in names}
+            steps = list()
+            for step in reversed(self.steps):
+                if any(y in required for y in step[3]):
+                    steps.append(step)
+                    required.difference_update(step[3])
+                    required.update(step[2])
+            self.schedules[names] = (steps[::-1], required)
+        return self.schedules[names]
+
+    def __call__(self, data, query=None):
+        if not isinstance(data, dict):
+            assert len(self.inputs) == 1
+            data = {next(iter(self.inputs)): data}
+        values = dict()
+        for name, value in data.items():
+            if name in self.inputs:
+                slot, dtype = self.inputs[name]
+                values[slot] = np.asarray(value, dtype=dtype)
+        if query is None:
+            # all outputs which can be computed from the given inputs
+            names = tuple(name for name in sorted(self.outputs) if self.schedule(names=(name,))[1].issubset(values))
+        elif isinstance(query, str):
+            names = (query,)
+        else:
+            names = tuple(query)
+        steps, required = self.schedule(names=names)
+        assert required.issubset(values), 'missing inputs for {}'.format(', '.join(names))
+        for op, arguments, xs, ys in steps:
+            outputs = getattr(NumpyEngine, op)(*(values[x] for x in xs), **arguments)
+            if len(ys) == 1:
+                values[ys[0]] = outputs
+            else:
+                values.update(zip(ys, outputs))
+        fetched = dict()
+        for name in names:
+            value = values[self.outputs[name]]
+            fetched[name] = np.transpose(value, (0, 3, 1, 2)) if name in self.transposed else value
+        if isinstance(query, str):
+            return dict(query=fetched[query])
         return fetched
 
+    def validate(self, data, query=None):
+        # maximum absolute difference to the TensorFlow outputs
+        names = list(self(data=data)) if query is None else ([query] if isinstance(query, str) else list(query))
+        expected = self.model(query=names, data=data)
+        fetched = self(data=data, query=names)
+        return {name: float(np.max(np.abs(np.asarray(expected[name], dtype=np.float64) - fetched[name]), initial=0.0)) for name in names}
+
+    def benchmark(self, data, query=None, repeats=100):
+        # average seconds per call, compared to a session run of the same outputs
+        assert isinstance(repeats, int) and repeats > 0
+        names = list(self(data=data)) if query is None else ([query] if isinstance(query, str) else list(query))
+        fetches = {name: self.model.tensors[name] for name in names}
+        feed_dict = self.model.get_feed_dict(data=data)
+        timings = dict()
+        runs = (('numpy', (lambda: self(data=data, query=names))), ('tensorflow', (lambda: self.model.session.run(fetches=fetches, feed_dict=feed_dict))))
+        for name, run in runs:
+            run()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                run()
+            timings[name] = (time.perf_counter() - start) / repeats
+        return timings
+
+    @staticmethod
+    def sigmoid(x):
+        return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+    @staticmethod
+    def pad(x, window, stride, padding, value):
+        # same padding as TensorFlow, with the larger half after
+        pads = [(0, 0)]
+        output_shape = list()
+        for dims, window_dims, stride_dims in zip(x.shape[1:3], window, stride):
+            if padding == 'SAME':
+                output_dims = (dims + stride_dims - 1) // stride_dims
+                total = max((output_dims - 1) * stride_dims + window_dims - dims, 0)
+                pads.append((total // 2, total - total // 2))
+            else:
+                output_dims = (dims - window_dims) // stride_dims + 1
+                pads.append((0, 0))
+            output_shape.append(output_dims)
+        pads.append((0, 0))
+        return np.pad(x, pads, mode='constant', constant_values=value), output_shape
+
+    @staticmethod
+    def matmul(x, weights):
+        return np.dot(x, weights)
+
+    @staticmethod
+    def bias_add(x, bias):
+        return x + bias
+
+    @staticmethod
+    def squeeze(x):
+        return x[..., 0]
+
+    @staticmethod
+    def multiply(x, y):
+        return x * y
+
+    @staticmethod
+    def activation(x, activation):
+        if activation == 'elu':
+            return np.where(x > 0.0, x, np.expm1(np.minimum(x, 0.0)))
+        elif activation == 'relu':
+            return np.maximum(x, 0.0)
+        elif activation == 'selu':
+            alpha = 1.6732632423543772848170429916717
+            scale = 1.0507009873554804934193349852946
+            return scale * np.where(x >= 0.0, x, alpha * np.expm1(np.minimum(x, 0.0)))
+        elif activation == 'sigmoid':
+            return NumpyEngine.sigmoid(x)
+        elif activation == 'softmax':
+            x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+            return x / np.sum(x, axis=-1, keepdims=True)
+        elif activation == 'tanh':
+            return np.tanh(x)
+
+    @staticmethod
+    def normalize(x, mean, variance, scale, offset, variance_epsilon):
+        if mean is None:
+            axes = tuple(range(1, x.ndim))
+            mean = np.mean(x, axis=axes, keepdims=True)
+            variance = np.var(x, axis=axes, keepdims=True)
+        x = (x - mean) / np.sqrt(variance + variance_epsilon)
+        if scale is not None:
+            x = x * scale
+        if offset is not None:
+            x = x + offset
+        return x
+
+    @staticmethod
+    def pool(x, pool, window, stride, padding):
+        if pool in ('max', 'maximum'):
+            x, (height, width) = NumpyEngine.pad(x=x, window=window, stride=stride, padding=padding, value=-np.inf)
+            counts = None
+        else:
+            # padded positions do not count towards the average
+            counts, _ = NumpyEngine.pad(x=np.ones_like(x[:1, :, :, :1]), window=window, stride=stride, padding=padding, value=0.0)
+            x, (height, width) = NumpyEngine.pad(x=x, window=window, stride=stride, padding=padding, value=0.0)
+        y = None
+        count = 0.0
+        for i in range(window[0]):
+            for j in range(window[1]):
+                rows = slice(i, i + stride[0] * (height - 1) + 1, stride[0])
+                columns = slice(j, j + stride[1] * (width - 1) + 1, stride[1])
+                patch = x[:, rows, columns, :]
+                if counts is None:
+                    y = patch if y is None else np.maximum(y, patch)
+                else:
+                    y = patch if y is None else y + patch
+                    count = count + counts[:, rows, columns, :]
+        return y if counts is None else y / count
+
+    @staticmethod
+    def convolution(x, filters, stride, dilation, padding, groups=1, depthwise=False):
+        squeezed = x.ndim == 3
+        if squeezed:
+            x = x[:, np.newaxis]
+            filters = filters[np.newaxis]
+            stride = (1,) + tuple(stride)
+            dilation = (1,) + tuple(dilation)
+        window = tuple((window_dims - 1) * dilation_dims + 1 for window_dims, dilation_dims in zip(filters.shape[:2], dilation))
+        x, (height, width) = NumpyEngine.pad(x=x, window=window, stride=stride, padding=padding, value=0.0)
+        channels = x.shape[-1] // groups
+        y = 0.0
+        # one matrix product per filter position, accumulated
+        for i in range(filters.shape[0]):
+            for j in range(filters.shape[1]):
+                rows = slice(i * dilation[0], i * dilation[0] + stride[0] * (height - 1) + 1, stride[0])
+                columns = slice(j * dilation[1], j * dilation[1] + stride[1] * (width - 1) + 1, stride[1])
+                patch = x[:, rows, columns, :]
+                if depthwise:
+                    y = y + patch * filters[i, j, :, 0]
+                elif groups == 1:
+                    y = y + np.dot(patch, filters[i, j])
+                else:
+                    group_filters = np.split(filters[i, j], groups, axis=-1)
+                    y = y + np.concatenate([np.dot(patch[..., n * channels:(n + 1) * channels], f) for n, f in enumerate(group_filters)], axis=-1)
+        return y[:, 0] if squeezed else y
+
+    @staticmethod
+    def index(x):
+        grids = np.meshgrid(*(np.linspace(-1.0, 1.0, num=dims, dtype=x.dtype) for dims in x.shape[1:-1]), indexing='ij')
+        index = np.stack(grids, axis=-1)
+        index = np.broadcast_to(index[np.newaxis], (x.shape[0],) + index.shape)
+        return np.concatenate((x, index), axis=-1)
+
+    @staticmethod
+    def gather(x, embeddings):
+        return embeddings[x]
+
+    @staticmethod
+    def reduction(*xs, reduction, axis, arg, multiple_inputs):
+        if multiple_inputs and reduction == 'last':
+            return xs[-1]
+        elif multiple_inputs and reduction in ('max', 'mean', 'min', 'prod', 'sum'):
+            ufunc = dict(max=np.maximum, mean=np.add, min=np.minimum, prod=np.multiply, sum=np.add)[reduction]
+            y = xs[0]
+            for x in xs[1:]:
+                y = ufunc(y, x)
+            return y / float(len(xs)) if reduction == 'mean' else y
+        elif not multiple_inputs and reduction in ('concat', 'stack'):
+            for a in reversed(axis):
+                xs = [y for x in xs for y in np.moveaxis(x, a, 0)]
+        if reduction in ('concat', 'stack'):
+            if len(xs) > 1:
+                # dimensions of one are tiled, as by make_least_common_shape
+                common_shape = [max(x.shape[r] for x in xs) for r in range(xs[0].ndim)]
+                xs = [np.broadcast_to(x, tuple(x.shape[r] if r == arg else dims for r, dims in enumerate(common_shape))) for x in xs]
+            if reduction == 'concat':
+                return np.concatenate(xs, axis=arg)
+            else:
+                return np.stack(xs, axis=arg)
+        x = xs[0]
+        if reduction == 'collapse':
+            start = axis[0]
+            end = axis[-1] + 1
+            return np.reshape(x, x.shape[:start] + (-1,) + x.shape[end:])
+        elif reduction == 'last':
+            for a in reversed(axis):
+                x = np.take(x, -1, axis=a)
+            return x
+        elif reduction == 'max':
+            return np.max(x, axis=axis)
+        elif reduction == 'mean':
+            return np.mean(x, axis=axis)
+        elif reduction == 'min':
+            return np.min(x, axis=axis)
+        elif reduction == 'prod':
+            return np.prod(x, axis=axis)
+        elif reduction == 'sum':
+            return np.sum(x, axis=axis)
+
+    @staticmethod
+    def rnn(x, *length, cell, weights, initial_state):
+        batch_size, num_steps = x.shape[:2]
+        state = np.repeat(initial_state, batch_size, axis=0)
+        if cell == 'lstm':
+            c, h = state[:, 0], state[:, 1]
+        else:
+            c, h = None, state
+        length = np.reshape(length[0], (-1,)) if length else None
+        outputs = np.zeros(shape=(batch_size, num_steps, h.shape[-1]), dtype=x.dtype)
+        for t in range(num_steps):
+            xh = np.concatenate((x[:, t], h), axis=1)
+            if cell == 'lstm':
+                # LSTMCell gate order, with forget bias 1.0
+                kernel, bias = weights
+                i, j, f, o = np.split(np.dot(xh, kernel) + bias, 4, axis=1)
+                next_c = NumpyEngine.sigmoid(f + 1.0) * c + NumpyEngine.sigmoid(i) * np.tanh(j)
+                next_h = NumpyEngine.sigmoid(o) * np.tanh(next_c)
+            else:
+                gate_kernel, gate_bias, candidate_kernel, candidate_bias = weights
+                r, u = np.split(NumpyEngine.sigmoid(np.dot(xh, gate_kernel) + gate_bias), 2, axis=1)
+                candidate = np.tanh(np.dot(np.concatenate((x[:, t], r * h), axis=1), candidate_kernel) + candidate_bias)
+                next_c = None
+                next_h = u * h + (1.0 - u) * candidate
+            if length is not None:
+                # finished sequences output zeros and keep their state
+                active = (t < length)[:, np.newaxis]
+                next_h = np.where(active, next_h, h)
+                next_c = None if c is None else np.where(active, next_c, c)
+                outputs[:, t] = np.where(active, next_h, 0.0)
+            else:
+                outputs[:, t] = next_h
+            c, h = next_c, next_h
+        return outputs, (h if c is None else np.concatenate((c, h), axis=1))
+
+    @staticmethod
+    def binary(x, binary_transform):
+        if binary_transform:
+            x = (np.tanh(x) + 1.0) / 2.0
+        return (x > 0.5).astype(x.dtype)
+
+    @staticmethod
+    def argmax(x, depth):
+        prediction = np.argmax(x, axis=1)
+        if depth is None:
+            return prediction
+        return np.eye(depth, dtype=x.dtype)[prediction]
+
+    @staticmethod
+    def top_k(x, k):
+        return np.argsort(-x, axis=-1, kind='stable')[..., :k].astype(np.int32)
+
 
 class Unit(object):
 
     num_in = None
     num_out = None
 
+    # units without variables only need a name scope instead of a variable-sharing template
+    stateless = False
+
     index = 0
+    index_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        unit = super(Unit, cls).__new__(cls)
+        unit.specification = (cls, args, kwargs)
+        return unit
 
     def __init__(self, name=None, template=True):
-        assert Model.current is not None
         assert self.num_in is not None and self.num_out is not None
         assert name is None or isinstance(name, str)
         if name is None:
-            name = self.__class__.__name__ + str(self.__class__.index)
-            self.__class__.index += 1
+            name = self.__class__.__name__ + str(Unit.next_index(cls=self.__class__))
         self.name = name
         self.initialized = False
         self.outputs = dict()
-        if template:
-            self.fn_forward = tf.make_template(name_=str(self), func_=self.forward, create_scope_now_=True)
+        self.template = template
+        # units defined outside a model are bound to the model they are first called in
+        self.model = Model.current
+        self.fn_forward = None if Model.current is None else self.make_forward()
+
+    @staticmethod
+    def next_index(cls):
+        # units are numbered per model, independently of other models built before or concurrently
+        if Model.current is not None:
+            return Model.current.next_unit_index(cls=cls)
+        with Unit.index_lock:
+            index = cls.index
+            cls.index += 1
+            return index
+
+    def make_forward(self):
+        if Model.current.dry_run:
+            return make_symbolic_template(name_=str(self), func_=self.infer) if self.template else self.infer
+        elif self.template and self.stateless:
+            return self.forward_in_name_scope
+        elif self.template:
+            return tf.make_template(name_=str(self), func_=self.forward, create_scope_now_=True)
         else:
-            self.fn_forward = self.forward
+            return self.forward
 
     def __str__(self):
         return self.name
@@ -317,26 +1856,50 @@ class Unit(object):
         if not self.initialized:
             self.initialize(*xs)
 
+    def infer(self, *xs):
+        return self.forward(*xs)
+
+    def forward_in_name_scope(self, *xs):
+        with tf.name_scope(name=str(self)):
+            return self.forward(*xs)
+
+    def num_flops(self, xs, ys):
+        return 0
+
+    def compile_numpy(self, engine, *xs):
+        assert False, 'no NumPy implementation for {}'.format(self.__class__.__name__)
+
     def __call__(self, inputs=(), output_key=None):
         assert output_key is None or isinstance(output_key, str)
+        if self.model is None:
+            self.model = Model.current
+        elif self.model is not Model.current:
+            # other models call their own instance, built from the specification of this unit
+            return Model.current.unit_instance(unit=self)(inputs=inputs, output_key=output_key)
         if output_key is not None and output_key in self.outputs:
             return self.outputs[output_key]
+        Model.current.enter_unit()
+        if self.fn_forward is None:
+            self.fn_forward = self.make_forward()
+        start = time.perf_counter()
         output = self.fn_forward(*inputs)
-        if isinstance(output, tf.Tensor):
+        seconds = time.perf_counter() - start
+        Model.current.register_unit(unit=self, inputs=inputs, outputs=output, seconds=seconds)
+        if is_tensor(output):
             if output_key is not None:
                 self.outputs[output_key] = output
-                Model.current.register_tensor(key=output_key, tensor=output)
+                Model.current.register_output(key=output_key, tensor=output)
         elif len(output) == 1:
             output = output[0]
             if output_key is not None:
                 self.outputs[output_key] = output
-                Model.current.register_tensor(key=output_key, tensor=output)
+                Model.current.register_output(key=output_key, tensor=output)
         else:
             output = tuple(output)
             if output_key is not None:
                 self.outputs[output_key] = output
                 for n, tensor in enumerate(output):
-                    Model.current.register_tensor(key=(output_key + str(n)), tensor=tensor)
+                    Model.current.register_output(key=(output_key + str(n)), tensor=tensor)
         return output
 
     def __rshift__(self, other):
@@ -344,22 +1907,22 @@ class Unit(object):
         if self.num_in == 0:
             assert self.num_out == other.num_in or other.num_in == -1, (self.num_out, other.num_in)
             inputs = self()
-            inputs = (inputs,) if isinstance(inputs, tf.Tensor) else inputs
+            inputs = (inputs,) if is_tensor(inputs) else inputs
             return other(inputs=inputs)
         else:
             return Composed(first=self, second=other)
 
     def __rrshift__(self, other):
-        if isinstance(other, tf.Tensor):
+        if is_tensor(other):
             return self(inputs=(other,))
         inputs = list()
         composed = False
         for x in other:
-            if isinstance(x, tf.Tensor):
+            if is_tensor(x):
                 inputs.append(x)
             elif x.num_in == 0:
                 x = x()
-                assert isinstance(x, tf.Tensor)
+                assert is_tensor(x)
                 inputs.append(x)
             elif isinstance(x, Unit):
                 inputs.append(x)
@@ -383,13 +1946,20 @@ class Composed(Unit):
             assert first.num_out == second.num_in or second.num_in == -1, (first.num_out, second.num_in)
             self.num_in = first.num_in
         else:
-            assert all(isinstance(unit, tf.Tensor) or unit.num_out == 1 for unit in first)
+            assert all(is_tensor(unit) or unit.num_out == 1 for unit in first)
             assert len(first) == second.num_in or second.num_in == -1, (len(first), second.num_in)
             self.num_in = 1
         self.num_out = second.num_out
         super(Composed, self).__init__(template=False)
         self.first = first
         self.second = second
+        # chains of units are applied in one loop instead of recursively re-dispatching
+        if not isinstance(first, Unit):
+            self.units = None
+        elif isinstance(first, Composed) and first.units is not None:
+            self.units = first.units + (second,)
+        else:
+            self.units = (first, second)
 
     def __str__(self):
         return '({} -> {})'.format(self.first, self.second)
@@ -402,19 +1972,31 @@ class Composed(Unit):
         super(Composed, self).forward(*xs)
         # assert isinstance(self.first, Unit) or len(xs) == 1
         if isinstance(self.first, Unit):
-            assert all(isinstance(x, tf.Tensor) for x in xs)
+            assert all(is_tensor(x) for x in xs)
             if len(xs) == 1:
                 xs = xs[0]
-            return xs >> self.first >> self.second
+            for unit in self.units:
+                xs >>= unit
+            return xs
         else:
-            assert all(isinstance(x, tf.Tensor) for x in xs)
+            assert all(is_tensor(x) for x in xs)
             if len(xs) == 1:
-                xs = tuple(unit if isinstance(unit, tf.Tensor) else xs[0] >> unit for unit in self.first)
+                xs = tuple(unit if is_tensor(unit) else xs[0] >> unit for unit in self.first)
             else:
-                xs = tuple(unit if isinstance(unit, tf.Tensor) else xs >> unit for unit in self.first)
-            assert all(isinstance(x, tf.Tensor) for x in xs)
+                xs = tuple(unit if is_tensor(unit) else xs >> unit for unit in self.first)
+            assert all(is_tensor(x) for x in xs)
             return xs >> self.second
 
+    def compile_numpy(self, engine, *xs):
+        if isinstance(self.first, Unit):
+            for unit in self.units:
+                xs = engine.call(unit=unit, xs=xs)
+            return xs
+        else:
+            xs = xs[0] if len(xs) == 1 else xs
+            xs = tuple(engine.slot(x=unit) if is_tensor(unit) else engine.call(unit=unit, xs=xs) for unit in self.first)
+            return engine.call(unit=self.second, xs=xs)
+
     def __rshift__(self, other):
         assert isinstance(other, Unit)
         return Composed(first=self, second=other)
@@ -429,10 +2011,10 @@ def customize(unit_, **specified):
             assert all(arg not in kwargs for arg in specified)
             kwargs.update(specified)
             if kwargs.get('name') is None:
-                kwargs['name'] = unit_.__name__ + str(unit_.index)
-                unit_.index += 1
+                kwargs['name'] = unit_.__name__ + str(Unit.next_index(cls=unit_))
             super(CustomUnit, self).__init__(**kwargs)
 
+    CustomUnit.customized = (unit_, specified)
     return CustomUnit
 
 
@@ -468,13 +2050,21 @@ class LayerStack(Unit):
             xs >>= layer
         return xs
 
+    def compile_numpy(self, engine, *xs):
+        for layer in self.layers:
+            xs = engine.call(unit=layer, xs=xs)
+        return xs
+
 
 class Variable(Unit):
 
     num_in = 0
     num_out = 1
 
-    def __init__(self, name, shape=None, dtype='float', init='out', value=None):
+    initializers = dict()
+    initializers_lock = threading.Lock()
+
+    def __init__(self, name, shape=None, dtype='float', init='out', value=None, trainable=True):
         super(Variable, self).__init__(name=name)
         assert self.__class__.num_in == 0 and self.__class__.num_out == 1
         assert isinstance(name, str)
@@ -483,10 +2073,16 @@ class Variable(Unit):
             assert len(shape) > 0 and all(isinstance(n, int) and n > 0 for n in shape)
         assert init in ('constant', 'zeros', 'ones', 'in', 'out', 'in-out', 'stddev') or Activation.valid(init)
         assert init in ('constant', 'zeros', 'ones') or dtype == 'float'
+        assert isinstance(trainable, bool)
         self.shape = shape
-        self.dtype, self.dtype_bytes = Model.dtype(dtype=dtype, include_bytes=True)
+        assert dtype in ('float', 'int', 'bool')
+        self.dtype = dtype
+        self.dtype_bytes = Model.precision // 8
         self.init = init
         self.value = value
+        self.trainable = trainable
+        self.variable = None
+        self.symbol = None
 
     def specify_shape(self, shape):
         if self.shape is None:
@@ -494,43 +2090,154 @@ class Variable(Unit):
         else:
             assert self.shape == shape
 
-    def forward(self):
-        super(Variable, self).forward()
-        # TODO: own instead of tf.contrib.layers.variance_scaling_initializer, and with min(?, 0.01)
-        assert self.shape is not None
+    def initializer(self, dtype):
         if self.init == 'zeros':
-            initializer = tf.zeros_initializer(dtype=self.dtype)
+            initializer = tf.zeros_initializer(dtype=dtype)
         elif self.init == 'ones':
-            initializer = tf.ones_initializer(dtype=self.dtype)
+            initializer = tf.ones_initializer(dtype=dtype)
         elif self.init == 'stddev':
             assert self.value is not None
             initializer = tf.random_normal_initializer(mean=0.0, stddev=self.value, dtype=tf.float32)
         elif self.init == 'selu':
-            initializer = tf.contrib.layers.variance_scaling_initializer(factor=1.0, mode='FAN_OUT', dtype=self.dtype)
+            initializer = tf.contrib.layers.variance_scaling_initializer(factor=1.0, mode='FAN_OUT', dtype=dtype)
         elif self.init == 'out':
-            initializer = tf.contrib.layers.variance_scaling_initializer(factor=2.0, mode='FAN_OUT', dtype=self.dtype)
+            initializer = tf.contrib.layers.variance_scaling_initializer(factor=2.0, mode='FAN_OUT', dtype=dtype)
         elif self.init == 'in' or self.init in ('elu', 'relu'):
             assert len(self.shape) >= 2
-            initializer = tf.contrib.layers.variance_scaling_initializer(factor=2.0, mode='FAN_IN', dtype=self.dtype)
+            initializer = tf.contrib.layers.variance_scaling_initializer(factor=2.0, mode='FAN_IN', dtype=dtype)
         elif self.init == 'in-out' or Activation.valid(self.init):
             assert len(self.shape) >= 2
-            initializer = tf.contrib.layers.variance_scaling_initializer(factor=1.0, mode='FAN_AVG', dtype=self.dtype)
+            initializer = tf.contrib.layers.variance_scaling_initializer(factor=1.0, mode='FAN_AVG', dtype=dtype)
         else:
             assert False
-        variable = tf.get_variable(name=str(self), shape=self.shape, dtype=self.dtype, initializer=initializer)
+        return initializer
+
+    def forward(self):
+        super(Variable, self).forward()
+        # TODO: own instead of tf.contrib.layers.variance_scaling_initializer, and with min(?, 0.01)
+        assert self.shape is not None
+        # initializers do not depend on the variable shape, so one instance per configuration is shared
+        dtype = Model.dtype(dtype=self.dtype)
+        key = (self.init, dtype, self.value)
+        # models may be built concurrently in several threads
+        with Variable.initializers_lock:
+            if key not in Variable.initializers:
+                Variable.initializers[key] = self.initializer(dtype=dtype)
+            initializer = Variable.initializers[key]
+        variable = tf.get_variable(name=str(self), shape=self.shape, dtype=dtype, initializer=initializer, trainable=self.trainable)
+        self.variable = variable
         num_parameters = product(self.shape)
         num_bytes = num_parameters * self.dtype_bytes
         Model.current.register_variable(key='{}/{}'.format(tf.get_variable_scope().name, str(self)), variable=variable, num_parameters=num_parameters, num_bytes=num_bytes)
         return tf.identity(input=variable)
 
+    def infer(self):
+        super(Variable, self).forward()
+        assert self.shape is not None
+        if self.symbol is None:
+            self.symbol = Symbol(shape=self.shape, dtype=self.dtype)
+        num_parameters = product(self.shape)
+        num_bytes = num_parameters * self.dtype_bytes
+        Model.current.register_variable(key='{}/{}'.format(Model.current.scopes[-1], str(self)), variable=self.symbol, num_parameters=num_parameters, num_bytes=num_bytes)
+        return self.symbol
+
+
+class Pruning(object):
+
+    def __init__(self, sparsity):
+        assert isinstance(sparsity, float) and 0.0 < sparsity < 1.0
+        self.sparsity = sparsity
+        self.mask = None
+        self.registered = False
+
+    def sparse(self, weights):
+        return rank(weights) == 2 and self.sparsity >= Model.sparse_threshold
+
+    def capacity(self, weights):
+        return max(int(round((1.0 - self.sparsity) * num_elements(weights))), 1)
+
+    @staticmethod
+    def pruned_counts(num_weights, num_kept, capacity, dtype_bytes):
+        num_parameters = num_weights - num_kept
+        if capacity is not None and num_kept <= capacity:
+            # sparse storage needs two int64 indices per remaining value
+            num_bytes = num_weights * dtype_bytes - capacity * (dtype_bytes + 16)
+        else:
+            num_bytes = 0
+        return num_parameters, num_bytes
+
+    def register(self, weights, update=None, refresh=None):
+        # shared units are pruned and counted once
+        if self.registered:
+            return
+        self.registered = True
+        _, dtype_bytes = Model.dtype(dtype='float', include_bytes=True)
+        capacity = self.capacity(weights=weights) if self.sparse(weights=weights) else None
+        if self.mask is None:
+            # dry runs count the pruned model at its target sparsity
+            num_parameters, num_bytes = Pruning.pruned_counts(num_weights=num_elements(weights), num_kept=self.capacity(weights=weights), capacity=capacity, dtype_bytes=dtype_bytes)
+            Model.current.register_pruning(num_parameters=num_parameters, num_bytes=num_bytes)
+        else:
+            count = tf.count_nonzero(input_tensor=self.mask)
+            Model.current.register_pruning(update=update, refresh=refresh, count=count, size=(num_elements(weights), capacity, dtype_bytes))
+
+    def apply(self, weights):
+        # magnitude pruning mask, updated by Model.prune according to the pruning schedule
+        if self.mask is not None:
+            return weights * self.mask
+        self.mask = tf.get_variable(name='mask', shape=shape(weights), dtype=weights.dtype, initializer=tf.ones_initializer(dtype=weights.dtype), trainable=False)
+        magnitudes = tf.abs(x=(weights * self.mask))
+        num_pruned = tf.cast(x=tf.floor(Model.current.pruning * self.sparsity * num_elements(weights)), dtype=tf.int32)
+        num_kept = tf.maximum(x=(num_elements(weights) - num_pruned), y=1)
+        threshold = tf.reduce_min(input_tensor=tf.nn.top_k(input=tf.reshape(tensor=magnitudes, shape=(-1,)), k=num_kept, sorted=False).values)
+        update = tf.assign(ref=self.mask, value=tf.cast(x=(magnitudes >= threshold), dtype=weights.dtype))
+        weights = weights * self.mask
+        if not self.sparse(weights=weights):
+            self.register(weights=weights, update=update)
+            return weights
+        # sparse copy of the largest weights, refreshed before inference after training steps, and only used
+        # once the mask keeps no more weights than the copy holds, so before the schedule reaches the target sparsity
+        capacity = self.capacity(weights=weights)
+        self.ready = tf.get_variable(name='sparse_ready', shape=(), dtype=tf.bool, initializer=tf.constant_initializer(value=False, dtype=tf.bool), trainable=False)
+        self.indices = tf.get_variable(name='sparse_indices', shape=(capacity, 2), dtype=tf.int64, initializer=tf.zeros_initializer(dtype=tf.int64), trainable=False)
+        self.values = tf.get_variable(name='sparse_values', shape=(capacity,), dtype=weights.dtype, initializer=tf.zeros_initializer(dtype=weights.dtype), trainable=False)
+        flat_weights = tf.reshape(tensor=weights, shape=(-1,))
+        positions = tf.cast(x=tf.nn.top_k(input=tf.abs(x=flat_weights), k=capacity, sorted=False).indices, dtype=tf.int64)
+        columns = shape(weights)[1]
+        refresh_indices = tf.assign(ref=self.indices, value=tf.stack(values=(positions // columns, positions % columns), axis=1))
+        refresh_values = tf.assign(ref=self.values, value=tf.gather(params=flat_weights, indices=positions))
+        refresh_ready = tf.assign(ref=self.ready, value=(tf.count_nonzero(input_tensor=self.mask) <= capacity))
+        self.register(weights=weights, update=update, refresh=tf.group(refresh_indices, refresh_values, refresh_ready))
+        return weights
+
+    def matmul(self, x, weights):
+        if not self.sparse(weights=weights):
+            return tf.matmul(a=x, b=weights)
+        sparse_outputs = list()
+
+        def sparse_fn():
+            sparse_weights = tf.SparseTensor(indices=self.indices, values=self.values, dense_shape=shape(weights))
+            return tf.transpose(a=tf.sparse_tensor_dense_matmul(sp_a=sparse_weights, b=x, adjoint_a=True, adjoint_b=True))
+
+        def inference_fn():
+            y = tf.cond(pred=self.ready, true_fn=sparse_fn, false_fn=(lambda: tf.matmul(a=x, b=weights)))
+            sparse_outputs.append(y)
+            return y
+
+        y = tf.cond(pred=Model.current.training, true_fn=(lambda: tf.matmul(a=x, b=weights)), false_fn=inference_fn)
+        # the exported inference graph only keeps the inference path
+        Model.current.register_bypass(output=y, input=sparse_outputs[0])
+        return y
+
 
 class Linear(Layer):
 
-    def __init__(self, size, bias=True, name=None):
+    def __init__(self, size, bias=True, pruning=None, name=None):
         super(Linear, self).__init__(size=size, name=name)
         assert isinstance(bias, bool)
         self.weights = None
         self.bias = bias
+        self.pruning = None if pruning is None else Pruning(sparsity=pruning)
 
     def initialize(self, x):
         super(Linear, self).initialize(x)
@@ -539,24 +2246,61 @@ class Linear(Layer):
         elif rank(x) == 3:
             self.weights = Variable(name='weights', shape=(1, shape(x)[-1], self.size), init='in-out')
         elif rank(x) == 4:
-            self.weights = Variable(name='weights', shape=(1, 1, shape(x)[-1], self.size), init='in-out')
+            self.weights = Variable(name='weights', shape=(1, 1, num_channels(x), self.size), init='in-out')
         self.bias = Variable(name='bias', shape=self.size, init='zeros') if self.bias else None
 
     def forward(self, x):
         super(Linear, self).forward(x)
         assert 2 <= rank(x) <= 4
-        if rank(x) == 2:
-            x = tf.matmul(a=x, b=self.weights())
+        axis = channel_axis(x)
+        weights = self.weights()
+        if self.pruning is not None:
+            weights = self.pruning.apply(weights=weights)
+        if rank(x) == 2 and self.pruning is not None:
+            x = self.pruning.matmul(x=x, weights=weights)
+        elif rank(x) == 2:
+            x = tf.matmul(a=x, b=weights)
         elif rank(x) == 3:
-            x = tf.nn.conv1d(value=x, filters=self.weights(), stride=1, padding='SAME')
+            x = tf.nn.conv1d(value=x, filters=weights, stride=1, padding='SAME')
         elif rank(x) == 4:
-            x = tf.nn.conv2d(input=x, filter=self.weights(), strides=(1, 1, 1, 1), padding='SAME')
+            x = tf.nn.conv2d(input=x, filter=weights, strides=(1, 1, 1, 1), padding='SAME', data_format=data_format(x))
         if self.bias is not None:
-            x = tf.nn.bias_add(value=x, bias=self.bias())
+            x = tf.nn.bias_add(value=x, bias=self.bias(), data_format=data_format(x))
         if self.squeeze:
-            x = tf.squeeze(input=x, axis=-1)
+            x = tf.squeeze(input=x, axis=axis)
         return x
 
+    def compile_numpy(self, engine, x):
+        weights = engine.value(variable=self.weights)
+        if self.pruning is not None:
+            weights = weights * engine.value(variable=self.pruning.mask)
+        x = engine.add('matmul', x, weights=np.reshape(weights, (-1, self.size)))
+        if self.bias is not None:
+            x = engine.add('bias_add', x, bias=engine.value(variable=self.bias))
+        if self.squeeze:
+            x = engine.add('squeeze', x)
+        return x
+
+    def infer(self, x):
+        super(Linear, self).forward(x)
+        assert 2 <= rank(x) <= 4
+        weights = self.weights()
+        if self.pruning is not None:
+            self.pruning.register(weights=weights)
+        if self.bias is not None:
+            self.bias()
+        x_shape = channels_last_shape(x)
+        if self.squeeze:
+            return Symbol(shape=x_shape[:-1], dtype=x.dtype)
+        else:
+            return Symbol(shape=data_format_shape(x_shape[:-1] + (self.size,)), dtype=x.dtype)
+
+    def num_flops(self, xs, ys):
+        num_flops = 2 * num_channels(xs[0]) * num_elements(ys[0])
+        if self.bias is not None:
+            num_flops += num_elements(ys[0])
+        return num_flops
+
 
 class Input(Unit):
 
@@ -570,7 +2314,8 @@ class Input(Unit):
         assert all(isinstance(n, int) and (n > 0 or n == -1) for n in shape)
         assert isinstance(batched, bool)
         self.shape = tuple(None if x == -1 else x for x in shape)
-        self.dtype = Model.dtype(dtype=dtype)
+        assert dtype in ('float', 'int', 'bool')
+        self.dtype = dtype
         if batched:
             self.shape = (None,) + self.shape
         self.tensor = tensor
@@ -578,9 +2323,23 @@ class Input(Unit):
     def forward(self):
         super(Input, self).forward()
         if self.tensor is None:
-            placeholder = tf.placeholder(dtype=self.dtype, shape=self.shape, name=str(self))
+            placeholder = tf.placeholder(dtype=Model.dtype(dtype=self.dtype), shape=self.shape, name=str(self))
             Model.current.register_placeholder(key=str(self), placeholder=placeholder)
-            self.tensor = tf.identity(input=placeholder)
+            # images are always fed channels-last, and transposed once here if the model is channels-first
+            if channels_first(placeholder):
+                self.tensor = tf.transpose(a=placeholder, perm=(0, 3, 1, 2))
+            else:
+                self.tensor = tf.identity(input=placeholder)
+        return self.tensor
+
+    def compile_numpy(self, engine):
+        assert str(self) in engine.model.placeholders
+        return engine.input(name=str(self))
+
+    def infer(self):
+        super(Input, self).forward()
+        if self.tensor is None:
+            self.tensor = Symbol(shape=data_format_shape(self.shape), dtype=self.dtype)
         return self.tensor
 
 
@@ -601,6 +2360,16 @@ class Output(Unit):
         super(Output, self).initialize(x)
         self.input = Input(name=str(self), shape=self.shape, dtype=self.dtype, batched=self.batched, tensor=self.tensor)
 
+    def streaming_counts(self, counts):
+        # accumulates the given per-batch sums in local counter variables over an evaluation
+        variables = list()
+        updates = list()
+        for name, count in counts:
+            variable = tf.get_variable(name=(name + '_count'), shape=(), dtype=count.dtype, initializer=tf.zeros_initializer(dtype=count.dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            variables.append(variable)
+            updates.append(tf.assign_add(ref=variable, value=count))
+        return variables, tf.group(*updates)
+
 
 class Binary(Output):
 
@@ -633,27 +2402,126 @@ class Binary(Output):
         num_correct = tf.cast(x=tf.equal(x=prediction, y=correct), dtype=Model.dtype('float'))
         accuracy = tf.reduce_mean(input_tensor=num_correct)
         Model.current.register_tensor(key=(str(self) + '_accuracy'), tensor=accuracy)
+        counts = (('correct', tf.reduce_sum(input_tensor=num_correct)), ('examples', tf.cast(x=tf.size(input=num_correct), dtype=Model.dtype('float'))))
+        variables, update = self.streaming_counts(counts=counts)
+        correct_count, example_count = variables
+        accuracy = correct_count / tf.maximum(x=example_count, y=1.0)
+        Model.current.register_metrics(metrics={(str(self) + '_accuracy'): accuracy}, update=update, variables=variables)
         return correct, prediction
 
+    def compile_numpy(self, engine, x):
+        correct = engine.input(name=str(self))
+        if self.binary_transform:
+            x = engine.call(unit=self.linear, xs=x)
+        return correct, engine.add('binary', x, binary_transform=self.binary_transform)
+
+    def infer(self, x):
+        super(Binary, self).forward(x)
+        correct = self.input()
+        if self.binary_transform:
+            x >>= self.linear
+        return correct, Symbol(shape=shape(x), dtype=Model.dtype('float'))
+
+    def num_flops(self, xs, ys):
+        return 10 * num_elements(ys[1])
+
 
 class Classification(Output):
 
-    def __init__(self, name, num_classes, multi_class=False, soft=0.0, tensor=None):
-        super(Classification, self).__init__(name=name, shape=(num_classes,), tensor=tensor)
+    @staticmethod
+    def valid_sampled_loss(sampled_loss):
+        return sampled_loss in ('softmax', 'nce')
+
+    def __init__(self, name, num_classes, multi_class=False, soft=0.0, sparse=False, num_sampled=None, sampled_loss='softmax', top_k=None, tensor=None):
+        # sparse labels are integer class indices, and sampled losses always train on them
+        assert isinstance(sparse, bool)
+        sparse = sparse or num_sampled is not None
+        if sparse:
+            super(Classification, self).__init__(name=name, shape=(), dtype='int', tensor=tensor)
+        else:
+            super(Classification, self).__init__(name=name, shape=(num_classes,), tensor=tensor)
         assert isinstance(num_classes, int) and num_classes > 0
         assert isinstance(multi_class, bool)
         assert isinstance(soft, float) and 0.0 <= soft < 0.5
+        assert not sparse or (not multi_class and soft == 0.0)
+        assert num_sampled is None or (isinstance(num_sampled, int) and 0 < num_sampled < num_classes)
+        assert Classification.valid_sampled_loss(sampled_loss)
+        assert top_k is None or (isinstance(top_k, int) and 0 < top_k <= num_classes)
         self.num_classes = num_classes
         self.multi_class = multi_class
         self.soft = soft
+        self.sparse = sparse
+        self.num_sampled = num_sampled
+        self.sampled_loss = sampled_loss
+        self.top_k = top_k
 
     def initialize(self, x):
         super(Classification, self).initialize(x)
-        self.linear = Linear(size=self.num_classes)
+        if self.num_sampled is None:
+            self.linear = Linear(size=self.num_classes)
+        else:
+            assert rank(x) == 2
+            self.weights = Variable(name='weights', shape=(self.num_classes, shape(x)[-1]), init='in-out')
+            self.bias = Variable(name='bias', shape=self.num_classes, init='zeros')
+
+    def register_top_k(self, x):
+        if self.top_k is not None:
+            _, top_k = tf.nn.top_k(input=x, k=self.top_k)
+            Model.current.register_tensor(key=(str(self) + '_top_k'), tensor=top_k)
+
+    def forward_sparse(self, x, correct):
+        labels = tf.cast(x=correct, dtype=tf.int64)
+        if self.num_sampled is None:
+            x >>= self.linear
+            tf.losses.sparse_softmax_cross_entropy(labels=labels, logits=x)
+        else:
+            weights = self.weights()
+            bias = self.bias()
+            if self.sampled_loss == 'softmax':
+                loss = tf.nn.sampled_softmax_loss(weights=weights, biases=bias, labels=tf.expand_dims(input=labels, axis=1), inputs=x, num_sampled=self.num_sampled, num_classes=self.num_classes)
+            elif self.sampled_loss == 'nce':
+                loss = tf.nn.nce_loss(weights=weights, biases=bias, labels=tf.expand_dims(input=labels, axis=1), inputs=x, num_sampled=self.num_sampled, num_classes=self.num_classes)
+            tf.losses.add_loss(loss=tf.reduce_mean(input_tensor=loss))
+            # full logits are only computed when predictions or metrics are fetched, not for the optimization step
+            x = tf.nn.bias_add(value=tf.matmul(a=x, b=weights, transpose_b=True), bias=bias)
+        self.register_top_k(x=x)
+        prediction = tf.argmax(input=x, axis=1)
+        # with one relevant and one selected class per example, precision and recall reduce to index comparisons
+        hits = tf.cast(x=tf.equal(x=prediction, y=labels), dtype=Model.dtype('float'))
+        precision = tf.reduce_mean(input_tensor=hits, axis=0)
+        Model.current.register_tensor(key=(str(self) + '_precision'), tensor=precision)
+        Model.current.register_tensor(key=(str(self) + '_recall'), tensor=precision)
+        Model.current.register_tensor(key=(str(self) + '_fscore'), tensor=precision)
+        self.register_streaming_metrics(example_precision=hits, example_recall=hits)
+        self.register_class_metrics(labels=labels, prediction=prediction, hits=hits)
+        return correct, prediction
+
+    def register_class_metrics(self, labels, prediction, hits):
+        # per-class counters updated by scatter, so the per-step cost does not grow with num_classes
+        variables = list()
+        for name in ('true_positive', 'selected', 'relevant'):
+            variable = tf.get_variable(name=(name + '_class_count'), shape=(self.num_classes,), dtype=hits.dtype, initializer=tf.zeros_initializer(dtype=hits.dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            variables.append(variable)
+        true_positive, selected, relevant = variables
+        ones = tf.ones_like(tensor=hits)
+        update = tf.group(
+            tf.scatter_add(ref=true_positive, indices=labels, updates=hits),
+            tf.scatter_add(ref=selected, indices=prediction, updates=ones),
+            tf.scatter_add(ref=relevant, indices=labels, updates=ones)
+        )
+        occurring = tf.cast(x=tf.greater(x=(selected + relevant), y=0.0), dtype=hits.dtype)
+        num_occurring = tf.maximum(x=tf.reduce_sum(input_tensor=occurring), y=1.0)
+        precision = tf.reduce_sum(input_tensor=(true_positive / tf.maximum(x=selected, y=1.0))) / num_occurring
+        recall = tf.reduce_sum(input_tensor=(true_positive / tf.maximum(x=relevant, y=1.0))) / num_occurring
+        fscore = (2 * precision * recall) / tf.maximum(x=(precision + recall), y=1e-8)
+        metrics = {(str(self) + '_macro_precision'): precision, (str(self) + '_macro_recall'): recall, (str(self) + '_macro_fscore'): fscore}
+        Model.current.register_metrics(metrics=metrics, update=update, variables=variables)
 
     def forward(self, x):
         super(Classification, self).forward(x)
         correct = self.input()
+        if self.sparse:
+            return self.forward_sparse(x=x, correct=correct)
         if not self.multi_class and rank(correct) == 1:
             correct_onehot = tf.one_hot(indices=correct, depth=self.num_classes)
         else:
@@ -668,6 +2536,7 @@ class Classification(Output):
             tf.losses.sigmoid_cross_entropy(multi_class_labels=soft_correct, logits=x)
         else:
             tf.losses.softmax_cross_entropy(onehot_labels=soft_correct, logits=x)
+        self.register_top_k(x=x)
         prediction = tf.argmax(input=x, axis=1)
         prediction_onehot = tf.one_hot(indices=prediction, depth=self.num_classes)
         if self.multi_class or rank(correct) == 2:
@@ -675,14 +2544,63 @@ class Classification(Output):
         relevant = tf.reduce_sum(input_tensor=correct, axis=1)
         selected = tf.reduce_sum(input_tensor=prediction_onehot, axis=1)
         true_positive = tf.reduce_sum(input_tensor=tf.minimum(x=prediction_onehot, y=correct), axis=1)
-        precision = tf.reduce_mean(input_tensor=tf.divide(x=true_positive, y=selected), axis=0)
-        recall = tf.reduce_mean(input_tensor=tf.divide(x=true_positive, y=relevant), axis=0)
+        example_precision = tf.divide(x=true_positive, y=selected)
+        example_recall = tf.divide(x=true_positive, y=relevant)
+        precision = tf.reduce_mean(input_tensor=example_precision, axis=0)
+        recall = tf.reduce_mean(input_tensor=example_recall, axis=0)
         fscore = (2 * precision * recall) / (precision + recall)
         Model.current.register_tensor(key=(str(self) + '_precision'), tensor=precision)
         Model.current.register_tensor(key=(str(self) + '_recall'), tensor=recall)
         Model.current.register_tensor(key=(str(self) + '_fscore'), tensor=fscore)
+        self.register_streaming_metrics(example_precision=example_precision, example_recall=example_recall)
+        return correct, prediction
+
+    def compile_numpy(self, engine, x):
+        correct = engine.input(name=str(self))
+        if self.num_sampled is None:
+            x = engine.call(unit=self.linear, xs=x)
+        else:
+            x = engine.add('matmul', x, weights=engine.value(variable=self.weights).T)
+            x = engine.add('bias_add', x, bias=engine.value(variable=self.bias))
+        if self.top_k is not None:
+            engine.register(key=(str(self) + '_top_k'), slot=engine.add('top_k', x, k=self.top_k))
+        onehot = not self.sparse and (self.multi_class or rank(self.input.tensor) == 2)
+        return correct, engine.add('argmax', x, depth=(self.num_classes if onehot else None))
+
+    def register_streaming_metrics(self, example_precision, example_recall):
+        counts = (
+            ('precision', tf.reduce_sum(input_tensor=example_precision)),
+            ('recall', tf.reduce_sum(input_tensor=example_recall)),
+            ('examples', tf.cast(x=tf.size(input=example_precision), dtype=example_precision.dtype))
+        )
+        variables, update = self.streaming_counts(counts=counts)
+        precision_count, recall_count, example_count = variables
+        precision = precision_count / tf.maximum(x=example_count, y=1.0)
+        recall = recall_count / tf.maximum(x=example_count, y=1.0)
+        fscore = (2 * precision * recall) / (precision + recall)
+        metrics = {(str(self) + '_precision'): precision, (str(self) + '_recall'): recall, (str(self) + '_fscore'): fscore}
+        Model.current.register_metrics(metrics=metrics, update=update, variables=variables)
+
+    def infer(self, x):
+        super(Classification, self).forward(x)
+        correct = self.input()
+        if self.num_sampled is None:
+            x >>= self.linear
+        else:
+            self.weights()
+            self.bias()
+        if self.multi_class or rank(correct) == 2:
+            prediction = Symbol(shape=(shape(x)[:-1] + (self.num_classes,)), dtype=Model.dtype('float'))
+        else:
+            prediction = Symbol(shape=shape(x)[:1], dtype=Model.dtype('int'))
         return correct, prediction
 
+    def num_flops(self, xs, ys):
+        num_flops = 5 * self.num_classes * num_elements(xs[0]) // shape(xs[0])[-1]
+        if self.num_sampled is not None:
+            num_flops += 2 * num_elements(xs[0]) * self.num_classes
+        return num_flops
+
 
 class Distance(Output):
 
@@ -696,22 +2614,38 @@ class Distance(Output):
         tf.losses.mean_squared_error(labels=correct, predictions=prediction)
         return correct, prediction
 
+    def compile_numpy(self, engine, x):
+        return engine.input(name=str(self)), x
+
+    def infer(self, x):
+        super(Distance, self).forward(x)
+        correct = self.input()
+        return correct, x
+
+    def num_flops(self, xs, ys):
+        return 3 * num_elements(xs[0])
+
 
 class Identity(Unit):
 
     num_in = 1
     num_out = 1
+    stateless = True
 
     def forward(self, *xs):
         super(Identity, self).forward(*xs)
         assert len(xs) >= 1
         return xs[0] if len(xs) == 1 else xs
 
+    def compile_numpy(self, engine, *xs):
+        return xs
+
 
 class Print(Unit):
 
     num_in = -1
     num_out = -1
+    stateless = True
 
     def __init__(self, size=10, times=None, prefix=None, name=None):
         super(Print, self).__init__(name=name)
@@ -730,13 +2664,23 @@ class Print(Unit):
             message = self.prefix + ' '
         else:
             message = self.prefix + ': '
-        return (tf.Print(input_=xs[0], data=xs, message=message, first_n=self.times, summarize=self.size),) + tuple(xs[1:])
+        x = tf.Print(input_=xs[0], data=xs, message=message, first_n=self.times, summarize=self.size)
+        Model.current.register_bypass(output=x, input=xs[0])
+        return (x,) + tuple(xs[1:])
+
+    def compile_numpy(self, engine, *xs):
+        return xs
+
+    def infer(self, *xs):
+        super(Print, self).forward(*xs)
+        return tuple(xs)
 
 
 class Constant(Unit):
 
     num_in = 1
     num_out = 1
+    stateless = True
 
     def __init__(self, value, dtype, name=None):
         super(Constant, self).__init__(name=name)
@@ -750,11 +2694,21 @@ class Constant(Unit):
         multiples = (batch_size,) + tuple(1 for _ in range(rank(x)))
         return tf.tile(input=tf.expand_dims(input=x, axis=0), multiples=multiples)
 
+    def infer(self, x):
+        super(Constant, self).forward(x)
+        value_shape = ()
+        value = self.value
+        while isinstance(value, (list, tuple)):
+            value_shape += (len(value),)
+            value = value[0]
+        return Symbol(shape=(shape(x)[:1] + value_shape), dtype=Model.dtype(self.dtype))
+
 
 class Select(Unit):
 
     num_in = -1
     num_out = 1
+    stateless = True
 
     def __init__(self, index, name=None):
         super(Select, self).__init__(name=name)
@@ -766,11 +2720,15 @@ class Select(Unit):
         assert len(xs) > self.index
         return xs[self.index]
 
+    def compile_numpy(self, engine, *xs):
+        return xs[self.index]
+
 
 class Activation(Unit):
 
     num_in = 1
     num_out = 1
+    stateless = True
 
     @staticmethod
     def valid(activation):
@@ -795,19 +2753,47 @@ class Activation(Unit):
         elif self.activation == 'sigmoid':
             return tf.sigmoid(x=x)
         elif self.activation == 'softmax':
-            return tf.nn.softmax(logits=x)
+            return tf.nn.softmax(logits=x, dim=channel_axis(x))
         elif self.activation == 'tanh':
             return tf.nn.tanh(x=x)
 
+    def compile_numpy(self, engine, x):
+        return engine.add('activation', x, activation=self.activation)
+
+    def infer(self, x):
+        super(Activation, self).forward(x)
+        return Symbol(shape=shape(x), dtype=x.dtype)
+
+    def num_flops(self, xs, ys):
+        if self.activation == 'relu':
+            return num_elements(xs[0])
+        elif self.activation == 'softmax':
+            return 5 * num_elements(xs[0])
+        else:
+            return 4 * num_elements(xs[0])
+
 
 class Dropout(Unit):
 
     num_in = 1
     num_out = 1
+    stateless = True
 
     def forward(self, x):
         super(Dropout, self).forward(x)
-        return tf.nn.dropout(x=x, keep_prob=(1.0 - Model.current.dropout))
+        y = tf.nn.dropout(x=x, keep_prob=(1.0 - Model.current.dropout))
+        Model.current.register_bypass(output=y, input=x)
+        return y
+
+    def compile_numpy(self, engine, x):
+        return x
+
+    def infer(self, x):
+        super(Dropout, self).forward(x)
+        return Symbol(shape=shape(x), dtype=x.dtype)
+
+    def num_flops(self, xs, ys):
+        return 2 * num_elements(xs[0])
 
 
 class Normalization(Unit):
@@ -819,22 +2805,37 @@ class Normalization(Unit):
     def valid(normalization):
         return normalization in ('instance', 'batch', 'global')
 
-    def __init__(self, normalization, scale=True, offset=True, variance_epsilon=1e-6, name=None):
+    def __init__(self, normalization, scale=True, offset=True, variance_epsilon=1e-6, fused=False, decay=0.9, name=None):
         super(Normalization, self).__init__(name=name)
         assert Normalization.valid(normalization)
         assert isinstance(scale, bool)
         assert isinstance(offset, bool)
         assert isinstance(variance_epsilon, float) and variance_epsilon > 0.0
+        assert isinstance(fused, bool)
+        assert isinstance(decay, float) and 0.0 < decay < 1.0
         self.normalization = normalization
         self.scale = scale
         self.offset = offset
         self.variance_epsilon = variance_epsilon
+        self.fused = fused
+        self.decay = decay
 
     def initialize(self, x):
         super(Normalization, self).initialize(x)
-        if self.normalization != 'instance':
-            self.exp_moving_average = tf.train.ExponentialMovingAverage(decay=0.9, num_updates=None)
-        mean_shape = tuple(1 for _ in range(rank(x) - 1)) + (shape(x)[-1],)
+        # the fused kernel normalizes over all but the channel axis, instance statistics use examples as channels
+        if self.fused and self.normalization == 'global':
+            assert 2 <= rank(x) <= 4, 'fused global normalization requires inputs of rank 2 to 4'
+        elif self.fused and self.normalization == 'batch':
+            assert rank(x) == 2, 'fused batch normalization of per-position statistics requires inputs of rank 2'
+        if self.fused and self.normalization != 'instance':
+            mean_shape = (num_channels(x),)
+            self.moving_mean = Variable(name='moving_mean', shape=mean_shape, init='zeros', trainable=False)
+            self.moving_variance = Variable(name='moving_variance', shape=mean_shape, init='ones', trainable=False)
+        else:
+            mean_shape = tuple(num_channels(x) if axis == channel_axis(x) else 1 for axis in range(rank(x)))
+            if self.normalization != 'instance' and not Model.current.dry_run:
+                self.exp_moving_average = tf.train.ExponentialMovingAverage(decay=self.decay, num_updates=None)
+                self.moving_averages = list()
         if self.scale:
             self.scale = Variable(name='scale', shape=mean_shape, init='zeros')
         else:
@@ -844,14 +2845,70 @@ class Normalization(Unit):
         else:
             self.offset = None
 
+    def forward_fused_instance(self, x):
+        x_shape = tf.shape(input=x)
+        y = tf.transpose(a=tf.reshape(tensor=x, shape=(x_shape[0], -1)))
+        y = tf.expand_dims(input=tf.expand_dims(input=y, axis=0), axis=0)
+        ones = tf.ones(shape=x_shape[:1], dtype=x.dtype)
+        y, _, _ = tf.nn.fused_batch_norm(x=y, scale=ones, offset=tf.zeros_like(tensor=ones), epsilon=self.variance_epsilon, data_format='NHWC', is_training=True)
+        y = tf.reshape(tensor=tf.transpose(a=tf.squeeze(input=y, axis=(0, 1))), shape=x_shape)
+        y.set_shape(shape=x.shape)
+        if self.scale is not None:
+            y *= 1.0 + self.scale()
+        if self.offset is not None:
+            y += self.offset()
+        return y
+
+    def forward_fused(self, x):
+        channels = num_channels(x)
+        if self.scale is None:
+            scale = tf.ones(shape=(channels,), dtype=x.dtype)
+        else:
+            scale = 1.0 + self.scale()
+        if self.offset is None:
+            offset = tf.zeros(shape=(channels,), dtype=x.dtype)
+        else:
+            offset = self.offset()
+        moving_mean = self.moving_mean()
+        moving_variance = self.moving_variance()
+        if rank(x) == 2:
+            y = tf.expand_dims(input=tf.expand_dims(input=x, axis=1), axis=1)
+        elif rank(x) == 3:
+            y = tf.expand_dims(input=x, axis=2)
+        else:
+            y = x
+
+        def true_fn():
+            z, mean, variance = tf.nn.fused_batch_norm(x=y, scale=scale, offset=offset, epsilon=self.variance_epsilon, data_format=data_format(x), is_training=True)
+            update_mean = tf.assign_sub(ref=self.moving_mean.variable, value=((1.0 - self.decay) * (moving_mean - mean)))
+            update_variance = tf.assign_sub(ref=self.moving_variance.variable, value=((1.0 - self.decay) * (moving_variance - variance)))
+            with tf.control_dependencies(control_inputs=(update_mean, update_variance)):
+                return tf.identity(input=z)
+
+        def false_fn():
+            z, _, _ = tf.nn.fused_batch_norm(x=y, scale=scale, offset=offset, mean=moving_mean, variance=moving_variance, epsilon=self.variance_epsilon, data_format=data_format(x), is_training=False)
+            return z
+
+        y = tf.cond(pred=Model.current.training, true_fn=true_fn, false_fn=false_fn)
+        if rank(x) == 2:
+            return tf.squeeze(input=y, axis=(1, 2))
+        elif rank(x) == 3:
+            return tf.squeeze(input=y, axis=2)
+        else:
+            return y
+
     def forward(self, x):
         super(Normalization, self).forward(x)
+        if self.fused and self.normalization == 'instance':
+            return self.forward_fused_instance(x=x)
+        elif self.fused:
+            return self.forward_fused(x=x)
         if self.normalization == 'instance':
             mean, variance = tf.nn.moments(x=x, axes=tuple(range(1, rank(x))), keep_dims=True)
         elif self.normalization == 'batch':
             mean, variance = tf.nn.moments(x=x, axes=(0,), keep_dims=True)
         elif self.normalization == 'global':
-            mean, variance = tf.nn.moments(x=x, axes=tuple(range(rank(x) - 1)), keep_dims=True)
+            mean, variance = tf.nn.moments(x=x, axes=tuple(axis for axis in range(rank(x)) if axis != channel_axis(x)), keep_dims=True)
 
         if self.normalization != 'instance':
 
@@ -861,7 +2918,10 @@ class Normalization(Unit):
                     return tf.identity(input=mean), tf.identity(input=variance)
 
             def false_fn():
-                return self.exp_moving_average.average(var=mean), self.exp_moving_average.average(var=variance)
+                averages = (self.exp_moving_average.average(var=mean), self.exp_moving_average.average(var=variance))
+                # one pair of averages per call of the unit
+                self.moving_averages.append(averages)
+                return averages
 
             mean, variance = tf.cond(pred=Model.current.training, true_fn=true_fn, false_fn=false_fn)
 
@@ -875,6 +2935,38 @@ class Normalization(Unit):
             offset = self.offset()
         return tf.nn.batch_normalization(x=x, mean=mean, variance=variance, offset=offset, scale=scale, variance_epsilon=self.variance_epsilon)
 
+    def compile_numpy(self, engine, x):
+        scale = None if self.scale is None else 1.0 + engine.channels_last(value=engine.value(variable=self.scale))
+        offset = None if self.offset is None else engine.channels_last(value=engine.value(variable=self.offset))
+        variance_epsilon = self.variance_epsilon
+        if self.fused:
+            # fused_batch_norm raises smaller epsilons to this minimum
+            variance_epsilon = max(variance_epsilon, 1.001e-5)
+        if self.normalization == 'instance':
+            mean = variance = None
+        elif self.fused:
+            mean = engine.value(variable=self.moving_mean)
+            variance = engine.value(variable=self.moving_variance)
+        else:
+            mean, variance = self.moving_averages[engine.occurrence(unit=self)]
+            mean = engine.channels_last(value=engine.value(variable=mean))
+            variance = engine.channels_last(value=engine.value(variable=variance))
+        return engine.add('normalize', x, mean=mean, variance=variance, scale=scale, offset=offset, variance_epsilon=variance_epsilon)
+
+    def infer(self, x):
+        super(Normalization, self).forward(x)
+        if self.fused and self.normalization != 'instance':
+            self.moving_mean()
+            self.moving_variance()
+        if self.scale is not None:
+            self.scale()
+        if self.offset is not None:
+            self.offset()
+        return Symbol(shape=shape(x), dtype=x.dtype)
+
+    def num_flops(self, xs, ys):
+        return 5 * num_elements(xs[0])
+
 
 class FeaturewiseLinearModulation(Unit):
 
@@ -890,18 +2982,31 @@ class FeaturewiseLinearModulation(Unit):
 
     def initialize(self, x, condition):
         super(FeaturewiseLinearModulation, self).initialize(x, condition)
-        size = shape(x)[-1]
+        size = num_channels(x)
         self.scale = self.scale(size=size)
         self.offset = self.offset(size=size)
 
     def forward(self, x, condition):
         super(FeaturewiseLinearModulation, self).forward(x, condition)
         scale = 1.0 + (condition >> self.scale)
-        scale = tf.expand_dims(input=tf.expand_dims(input=scale, axis=1), axis=2)
         offset = condition >> self.offset
-        offset = tf.expand_dims(input=tf.expand_dims(input=offset, axis=1), axis=2)
+        if channels_first(x):
+            scale = tf.expand_dims(input=tf.expand_dims(input=scale, axis=2), axis=3)
+            offset = tf.expand_dims(input=tf.expand_dims(input=offset, axis=2), axis=3)
+        else:
+            scale = tf.expand_dims(input=tf.expand_dims(input=scale, axis=1), axis=2)
+            offset = tf.expand_dims(input=tf.expand_dims(input=offset, axis=1), axis=2)
         return x * scale + offset
 
+    def infer(self, x, condition):
+        super(FeaturewiseLinearModulation, self).forward(x, condition)
+        condition >> self.scale
+        condition >> self.offset
+        return Symbol(shape=shape(x), dtype=x.dtype)
+
+    def num_flops(self, xs, ys):
+        return 2 * num_elements(xs[0])
+
 
 class FiLM(Unit):
 
@@ -988,6 +3093,26 @@ class Reduction(Unit):
         if self.reduction in ('conv', 'conv2d'):
             self.weights = Variable(name='weights', init='in-out')
 
+    def normalize_axis(self, x):
+        if len(self.axis) == 3 and self.axis[1] is Ellipsis:
+            start, _, end = self.axis
+            start = start if start >= 0 else rank(x) + start
+            end = end if end >= 0 else rank(x) + end
+            self.axis = tuple(range(start, end + 1))
+        elif any(a < 0 for a in self.axis):
+            self.axis = tuple(sorted(a if a >= 0 else rank(x) + a for a in self.axis))
+            assert len(set(self.axis)) == len(self.axis)
+        assert self.axis[0] >= 0 and self.axis[-1] < rank(x)
+
+    def channels_first_axis(self, x):
+        # axes refer to the channels-last layout, so reduce in place only if the remaining axes keep their order
+        permutation = (0, 2, 3, 1)
+        remaining = [permutation[axis] for axis in range(rank(x)) if axis not in self.axis]
+        if self.reduction in ('max', 'mean', 'min', 'prod', 'sum') and remaining == sorted(remaining):
+            return x, tuple(sorted(permutation[axis] for axis in self.axis))
+        else:
+            return to_channels_last(x), self.axis
+
     def forward(self, *xs):
         super(Reduction, self).forward(*xs)
         assert len(xs) > 0
@@ -1030,21 +3155,16 @@ class Reduction(Unit):
                 return y
 
             elif self.reduction in ('collapse', 'conv', 'conv2d'):
-                xs = make_least_common_shape(xs=xs)
+                xs = make_least_common_shape(xs=[to_channels_last(x) for x in xs])
                 x = tf.stack(values=xs, axis=axis)
 
         else:
             x = xs[0]
-
-            if len(self.axis) == 3 and self.axis[1] is Ellipsis:
-                start, _, end = self.axis
-                start = start if start >= 0 else rank(x) + start
-                end = end if end >= 0 else rank(x) + end
-                self.axis = tuple(range(start, end + 1))
-            elif any(a < 0 for a in self.axis):
-                self.axis = tuple(sorted(a if a >= 0 else rank(x) + a for a in self.axis))
-                assert len(set(self.axis)) == len(self.axis)
-            assert self.axis[0] >= 0 and self.axis[-1] < rank(x)
+            self.normalize_axis(x=x)
+            axis = self.axis
+            if channels_first(x):
+                x, axis = self.channels_first_axis(x=x)
+                xs = (x,)
 
             if self.reduction in ('concat', 'stack'):
                 for axis in reversed(self.axis):
@@ -1101,22 +3221,93 @@ class Reduction(Unit):
                 return x
 
         elif self.reduction == 'max':
-            return tf.reduce_max(input_tensor=x, axis=self.axis)
+            return tf.reduce_max(input_tensor=x, axis=axis)
 
         elif self.reduction == 'mean':
-            return tf.reduce_mean(input_tensor=x, axis=self.axis)
+            return tf.reduce_mean(input_tensor=x, axis=axis)
 
         elif self.reduction == 'min':
-            return tf.reduce_min(input_tensor=x, axis=self.axis)
+            return tf.reduce_min(input_tensor=x, axis=axis)
 
         elif self.reduction == 'prod':
-            return tf.reduce_prod(input_tensor=x, axis=self.axis)
+            return tf.reduce_prod(input_tensor=x, axis=axis)
 
         elif self.reduction == 'stack':
             return tf.stack(values=xs, axis=self.arg)
 
         elif self.reduction == 'sum':
-            return tf.reduce_sum(input_tensor=x, axis=self.axis)
+            return tf.reduce_sum(input_tensor=x, axis=axis)
+
+    def compile_numpy(self, engine, *xs):
+        assert self.reduction in ('collapse', 'concat', 'last', 'max', 'mean', 'min', 'prod', 'stack', 'sum')
+        assert not (self.multiple_inputs and self.reduction == 'collapse')
+        return engine.add('reduction', *xs, reduction=self.reduction, axis=self.axis, arg=self.arg, multiple_inputs=self.multiple_inputs)
+
+    def infer(self, *xs):
+        super(Reduction, self).forward(*xs)
+        assert len(xs) > 0
+        if self.multiple_inputs is None:
+            self.multiple_inputs = len(xs) > 1
+        dtype = xs[0].dtype
+
+        if self.multiple_inputs:
+            assert self.axis == (-1,)
+            assert all(rank(x) == rank(xs[0]) for x in xs)
+            shapes = [shape(x) for x in xs]
+            if self.reduction == 'last':
+                return Symbol(shape=shapes[-1], dtype=dtype)
+            elif self.reduction in ('max', 'mean', 'min', 'prod', 'sum'):
+                return Symbol(shape=tuple(max(dims) for dims in zip(*shapes)), dtype=dtype)
+            elif self.reduction in ('collapse', 'conv', 'conv2d'):
+                shapes = [channels_last_shape(x) for x in xs]
+                x_shape = tuple(max(dims) for dims in zip(*shapes)) + (len(xs),)
+
+        else:
+            x_shape = channels_last_shape(xs[0])
+            self.normalize_axis(x=xs[0])
+            if self.reduction in ('concat', 'stack'):
+                reduced_shape = tuple(dims for axis, dims in enumerate(x_shape) if axis not in self.axis)
+                shapes = [reduced_shape for _ in range(product(x_shape[axis] for axis in self.axis))]
+
+        if self.reduction in ('concat', 'stack'):
+            self.arg = self.arg if self.arg >= 0 else len(shapes[0]) + self.arg
+            assert 0 <= self.arg < len(shapes[0])
+            common_shape = tuple(max(dims) for dims in zip(*shapes))
+            if self.reduction == 'concat':
+                concat_dims = product_dims(s[self.arg] for s in shapes)
+                if concat_dims != -1:
+                    concat_dims = sum(s[self.arg] for s in shapes)
+                return Symbol(shape=(common_shape[:self.arg] + (concat_dims,) + common_shape[self.arg + 1:]), dtype=dtype)
+            else:
+                return Symbol(shape=(common_shape[:self.arg] + (len(shapes),) + common_shape[self.arg:]), dtype=dtype)
+
+        elif self.reduction == 'collapse':
+            start = self.axis[0]
+            end = self.axis[-1] + 1
+            return Symbol(shape=(x_shape[:start] + (product_dims(x_shape[start:end]),) + x_shape[end:]), dtype=dtype)
+
+        elif self.reduction == 'conv':
+            self.weights.specify_shape(shape=(1, product(x_shape[1:-1]), 1))
+            self.weights()
+            return Symbol(shape=(x_shape[0], x_shape[-1]), dtype=dtype)
+
+        elif self.reduction == 'conv2d':
+            self.weights.specify_shape(shape=(x_shape[1], x_shape[2], x_shape[-1], x_shape[-1]))
+            self.weights()
+            return Symbol(shape=(x_shape[0], x_shape[-1]), dtype=dtype)
+
+        else:
+            return Symbol(shape=tuple(dims for axis, dims in enumerate(x_shape) if axis not in self.axis), dtype=dtype)
+
+    def num_flops(self, xs, ys):
+        if self.reduction in ('max', 'mean', 'min', 'prod', 'sum'):
+            return sum(num_elements(x) for x in xs)
+        elif self.reduction == 'conv':
+            return 2 * sum(num_elements(x) for x in xs)
+        elif self.reduction == 'conv2d':
+            return 2 * sum(num_elements(x) for x in xs) * shape(ys[0])[-1]
+        else:
+            return 0
 
 
 # class Concatenation(Unit):
@@ -1167,12 +3358,27 @@ class Attention(Unit):
     def forward(self, x, query):
         super(Attention, self).forward(x, query)
         assert rank(x) > 2 and rank(query) == 2 and shape(query)[0] == shape(x)[0]
+        x = to_channels_last(x)
         for _ in range(rank(x) - 2):
             query = tf.expand_dims(input=query, axis=1)
-        attention = (x, query) >> self.assessment >> self.softmax
-        assert shape(attention) == shape(x)[:-1]
-        attention = tf.expand_dims(input=attention, axis=(rank(x) - 1))
-        return (x * attention) >> self.reduction
+        with channels_last_section():
+            attention = (x, query) >> self.assessment >> self.softmax
+            assert shape(attention) == shape(x)[:-1]
+            attention = tf.expand_dims(input=attention, axis=(rank(x) - 1))
+            return (x * attention) >> self.reduction
+
+    def infer(self, x, query):
+        super(Attention, self).forward(x, query)
+        assert rank(x) > 2 and rank(query) == 2 and shape(query)[0] == shape(x)[0]
+        x = to_channels_last(x)
+        query = Symbol(shape=(shape(query)[:1] + tuple(1 for _ in range(rank(x) - 2)) + shape(query)[1:]), dtype=query.dtype)
+        with channels_last_section():
+            attention = (x, query) >> self.assessment >> self.softmax
+            assert shape(attention) == shape(x)[:-1]
+            return Symbol(shape=shape(x), dtype=x.dtype) >> self.reduction
+
+    def num_flops(self, xs, ys):
+        return num_elements(xs[0])
 
 
 class CompactBilinearPooling(Unit):
@@ -1229,6 +3435,7 @@ class Pooling(Unit):
 
     num_in = 1
     num_out = 1
+    stateless = True
 
     @staticmethod
     def valid(pool):
@@ -1241,23 +3448,44 @@ class Pooling(Unit):
         assert len(window) == 2 and all(isinstance(n, int) and n > 0 for n in window)
         assert padding in ('SAME', 'VALID')
         self.pool = pool
-        self.window = (1, window[0], window[1], 1)
+        self.window = window
         self.padding = padding
         if isinstance(stride, int):
             assert stride > 0
-            self.stride = stride if len(window) == 1 else (1, stride, stride, 1)
+            self.stride = (stride, stride)
         else:
             assert len(stride) == 2 and stride[0] > 0 and stride[1] > 0
-            self.stride = (1, stride[0], stride[1], 1)
+            self.stride = (stride[0], stride[1])
 
     def forward(self, x):
         super(Pooling, self).forward(x)
         if self.pool == 'none':
             return x
-        elif self.pool in ('avg', 'average'):
-            return tf.nn.avg_pool(value=x, ksize=self.window, strides=self.stride, padding=self.padding)
+        window = data_format_strides(x=x, stride=self.window)
+        stride = data_format_strides(x=x, stride=self.stride)
+        if self.pool in ('avg', 'average'):
+            return tf.nn.avg_pool(value=x, ksize=window, strides=stride, padding=self.padding, data_format=data_format(x))
         elif self.pool in ('max', 'maximum'):
-            return tf.nn.max_pool(value=x, ksize=self.window, strides=self.stride, padding=self.padding)
+            return tf.nn.max_pool(value=x, ksize=window, strides=stride, padding=self.padding, data_format=data_format(x))
+
+    def compile_numpy(self, engine, x):
+        if self.pool == 'none':
+            return x
+        return engine.add('pool', x, pool=self.pool, window=self.window, stride=self.stride, padding=self.padding)
+
+    def infer(self, x):
+        super(Pooling, self).forward(x)
+        if self.pool == 'none':
+            return x
+        assert rank(x) == 4
+        x_shape = channels_last_shape(x)
+        pooled_shape = tuple(strided_dims(dims=dims, window=window, stride=stride, padding=self.padding) for dims, window, stride in zip(x_shape[1:3], self.window, self.stride))
+        return Symbol(shape=data_format_shape(x_shape[:1] + pooled_shape + x_shape[3:]), dtype=x.dtype)
+
+    def num_flops(self, xs, ys):
+        if self.pool == 'none':
+            return 0
+        return num_elements(ys[0]) * self.window[0] * self.window[1]
 
 
     # def unpool(self, x, unpooling_type='zero'):  # zero, id
@@ -1290,13 +3518,18 @@ class Embedding(Unit):
     num_in = 1
     num_out = 1
 
-    def __init__(self, indices, size, name=None):
+    def __init__(self, indices, size, hot_size=None, sample_frequency=16, name=None):
         super(Embedding, self).__init__(name=name)
         assert isinstance(indices, int) and indices > 0
         assert isinstance(size, int) and size > 0
+        assert hot_size is None or (isinstance(hot_size, int) and 0 < hot_size < indices)
+        assert isinstance(sample_frequency, int) and sample_frequency > 0
         self.indices = indices
         self.size = size
+        self.hot_size = hot_size
+        self.sample_frequency = sample_frequency
         self.embeddings = None
+        self.slots = None
 
     def initialize(self, x):
         super(Embedding, self).initialize(x)
@@ -1304,7 +3537,66 @@ class Embedding(Unit):
 
     def forward(self, x):
         super(Embedding, self).forward(x)
-        return tf.nn.embedding_lookup(params=self.embeddings(), ids=x)
+        embeddings = self.embeddings()
+        if self.hot_size is None:
+            embedding = tf.nn.embedding_lookup(params=embeddings, ids=x)
+        else:
+            if self.slots is None:
+                self.initialize_hot_rows(embeddings=embeddings)
+            embedding = tf.cond(pred=Model.current.training, true_fn=(lambda: tf.nn.embedding_lookup(params=embeddings, ids=x)), false_fn=(lambda: self.hot_lookup(embeddings=embeddings, ids=x)))
+        if channels_first(embedding):
+            embedding = tf.transpose(a=embedding, perm=(0, 3, 1, 2))
+        return embedding
+
+    def compile_numpy(self, engine, x):
+        # the hot rows are copies of the full table, so lookups always use the latter
+        return engine.add('gather', x, embeddings=engine.value(variable=self.embeddings))
+
+    def initialize_hot_rows(self, embeddings):
+        # the most frequently looked-up rows are copied to a small table, with slots mapping ids to its rows
+        self.counts = tf.get_variable(name='counts', shape=(self.indices,), dtype=tf.int64, initializer=tf.zeros_initializer(dtype=tf.int64), trainable=False)
+        self.slots = tf.get_variable(name='slots', shape=(self.indices,), dtype=tf.int32, initializer=tf.constant_initializer(value=-1, dtype=tf.int32), trainable=False)
+        self.hot_embeddings = tf.get_variable(name='hot_embeddings', shape=(self.hot_size, self.size), dtype=embeddings.dtype, initializer=tf.zeros_initializer(dtype=embeddings.dtype), trainable=False)
+        self.lookups = tf.get_variable(name='lookups', shape=(), dtype=tf.int64, initializer=tf.zeros_initializer(dtype=tf.int64), trainable=False)
+        self.hits = tf.get_variable(name='hits', shape=(), dtype=tf.int64, initializer=tf.zeros_initializer(dtype=tf.int64), trainable=False)
+        self.calls = tf.get_variable(name='calls', shape=(), dtype=tf.int64, initializer=tf.zeros_initializer(dtype=tf.int64), trainable=False)
+        _, hot_ids = tf.nn.top_k(input=self.counts, k=self.hot_size, sorted=False)
+        slots = tf.scatter_nd(indices=tf.expand_dims(input=hot_ids, axis=1), updates=tf.range(start=1, limit=(self.hot_size + 1)), shape=(self.indices,)) - 1
+        refresh = tf.group(tf.assign(ref=self.slots, value=slots), tf.assign(ref=self.hot_embeddings, value=tf.gather(params=embeddings, indices=hot_ids)))
+        Model.current.register_refresh(refresh=refresh)
+        # estimated from the sampled lookups
+        hit_rate = tf.cast(x=self.hits, dtype=Model.dtype('float')) / tf.cast(x=tf.maximum(x=self.lookups, y=1), dtype=Model.dtype('float'))
+        Model.current.register_tensor(key=(str(self) + '_hit_rate'), tensor=hit_rate)
+
+    def hot_lookup(self, embeddings, ids):
+        flat_ids = tf.reshape(tensor=ids, shape=(-1,))
+        slots = tf.gather(params=self.slots, indices=flat_ids)
+        hits = slots >= 0
+        miss_positions = tf.where(condition=tf.logical_not(x=hits))
+        # all ids read from the small table, and only misses from the full table, which overwrite their rows
+        embedding = tf.gather(params=self.hot_embeddings, indices=tf.maximum(x=slots, y=0))
+        cold = tf.gather(params=embeddings, indices=tf.gather_nd(params=flat_ids, indices=miss_positions))
+        embedding = tf.tensor_scatter_nd_update(tensor=embedding, indices=miss_positions, updates=cold)
+        # frequency statistics are only updated on every sample_frequency-th lookup, to keep the scatter into the
+        # per-id counts off most calls
+        sampled = tf.equal(x=tf.mod(x=tf.assign_add(ref=self.calls, value=1), y=self.sample_frequency), y=0)
+        statistics = tf.cond(pred=sampled, true_fn=(lambda: tf.group(
+            tf.scatter_add(ref=self.counts, indices=flat_ids, updates=tf.ones_like(tensor=flat_ids, dtype=tf.int64)),
+            tf.assign_add(ref=self.lookups, value=tf.size(input=flat_ids, out_type=tf.int64)),
+            tf.assign_add(ref=self.hits, value=tf.reduce_sum(input_tensor=tf.cast(x=hits, dtype=tf.int64)))
+        )), false_fn=tf.no_op)
+        with tf.control_dependencies(control_inputs=(statistics,)):
+            sampled_embedding = tf.identity(input=embedding)
+        # exported inference graphs do not update statistics
+        Model.current.register_bypass(output=sampled_embedding, input=embedding)
+        embedding = tf.reshape(tensor=sampled_embedding, shape=tf.concat(values=(tf.shape(input=ids), (self.size,)), axis=0))
+        embedding.set_shape(shape=ids.shape.concatenate(other=(self.size,)))
+        return embedding
+
+    def infer(self, x):
+        super(Embedding, self).forward(x)
+        self.embeddings()
+        return Symbol(shape=data_format_shape(shape(x) + (self.size,)), dtype=Model.dtype('float'))
 
 
 class Split(Unit):
@@ -1313,6 +3605,8 @@ class Split(Unit):
     num_out = -1
 
     def __init__(self, axis=1, size=1, reduction=None, name=None):
+        # only a name scope unless the reduction owns variables, set before the forward function is created
+        self.stateless = reduction not in ('cbp', 'conv', 'conv2d')
         super(Split, self).__init__(name=name)
         axis = (axis,) if isinstance(axis, int) else tuple(sorted(axis, reverse=True))
         size = (size,) if isinstance(size, int) else tuple(size)
@@ -1328,7 +3622,8 @@ class Split(Unit):
 
     def forward(self, x):
         super(Split, self).forward(x)
-        xs = [x]
+        # axes refer to the channels-last layout, like Reduction axes, and split parts have lower rank
+        xs = [to_channels_last(x)]
         for a in self.axis:
             xs = [y for x in xs for y in tf.unstack(value=x, axis=a)]
         if self.size != (1,):
@@ -1337,15 +3632,70 @@ class Split(Unit):
             xs = [x >> self.reduction for x in xs]
         return tuple(xs)
 
+    def infer(self, x):
+        super(Split, self).forward(x)
+        x = to_channels_last(x)
+        xs = [x]
+        for a in self.axis:
+            assert shape(x)[a] != -1
+            xs = [Symbol(shape=(shape(x)[:a] + shape(x)[a + 1:]), dtype=x.dtype) for x in xs for _ in range(shape(x)[a])]
+        if self.size != (1,):
+            xs = chain(*(combinations(xs, r=s) for s in self.size))
+        if self.reduction is not None:
+            xs = [x >> self.reduction for x in xs]
+        return tuple(xs)
+
+
+class Batched(Unit):
+
+    num_in = -1
+    num_out = -1
+
+    def __init__(self, unit, name=None):
+        super(Batched, self).__init__(name=name)
+        assert isinstance(unit, Unit) and unit.num_in == 1 and unit.num_out == 1
+        self.unit = unit
+        self.unit_flops = 0
+
+    def call_unit(self, x):
+        num_flops = Model.current.num_flops
+        y = x >> self.unit
+        self.unit_flops = Model.current.num_flops - num_flops
+        return y
+
+    def forward(self, *xs):
+        super(Batched, self).forward(*xs)
+        assert len(xs) > 0 and all(shape(x)[1:] == shape(xs[0])[1:] for x in xs)
+        if len(xs) == 1:
+            return (self.call_unit(x=xs[0]),)
+        # one call of the shared unit on all inputs stacked along the batch axis, note that batch
+        # statistics, e.g. of batch normalization, are hence computed over all inputs together
+        batch_sizes = tf.stack(values=[tf.shape(input=x)[0] for x in xs])
+        x = tf.concat(values=xs, axis=0)
+        x = self.call_unit(x=x)
+        return tuple(tf.split(value=x, num_or_size_splits=batch_sizes, num=len(xs), axis=0))
+
+    def infer(self, *xs):
+        super(Batched, self).forward(*xs)
+        assert len(xs) > 0 and all(shape(x)[1:] == shape(xs[0])[1:] for x in xs)
+        y = self.call_unit(x=xs[0])
+        return (y,) + tuple(Symbol(shape=(shape(x)[:1] + shape(y)[1:]), dtype=y.dtype) for x in xs[1:])
+
+    def num_flops(self, xs, ys):
+        # flops are per example, and the shared unit is applied to every input
+        return (len(xs) - 1) * self.unit_flops
+
 
 class Relational(Unit):
 
     num_in = 2
     num_out = 1
 
-    def __init__(self, relation_unit, axis=1, relation_reduction='concat', reduction='sum', name=None):
+    def __init__(self, relation_unit, axis=1, relation_reduction='concat', reduction='sum', batched=False, name=None):
         super(Relational, self).__init__(name=name)
+        assert isinstance(batched, bool)
         self.relation_unit = relation_unit
+        self.batched = batched
         self.axis = axis
         self.relation_reduction = relation_reduction
         self.split = None
@@ -1354,12 +3704,19 @@ class Relational(Unit):
     def initialize(self, x, y):
         super(Relational, self).initialize(x, y)
         self.split = Split(axis=self.axis, size=2, reduction=self.relation_reduction)
+        if self.batched:
+            # opt-in: all pairs in one call, but batch statistics of the relation unit are shared across pairs
+            self.relation_unit = Batched(unit=self.relation_unit)
         self.reduction = Reduction(reduction=self.reduction)
 
     def forward(self, x, y):
         super(Relational, self).forward(x, y)
         xs = x >> self.split
-        xs = [(x, y) >> Reduction(reduction='concat') >> self.relation_unit for x in xs]
+        xs = [(x, y) >> Reduction(reduction='concat') for x in xs]
+        if self.batched:
+            xs >>= self.relation_unit
+        else:
+            xs = [x >> self.relation_unit for x in xs]
         return xs >> self.reduction
 
 
@@ -1367,6 +3724,7 @@ class Index(Unit):
 
     num_in = 1
     num_out = 1
+    stateless = True
 
     def __init__(self, name=None):
         super(Index, self).__init__(name=name)
@@ -1374,7 +3732,7 @@ class Index(Unit):
     def forward(self, x):
         super(Index, self).forward(x)
         index = None
-        indexed_shape = shape(x)[1:-1]
+        indexed_shape = channels_last_shape(x)[1:-1]
         for n, dims in enumerate(indexed_shape):
             delta = 2.0 / (dims - 1)
             next_index = tf.range(start=-1.0, limit=(1.0 + 0.5 * delta), delta=delta, dtype=Model.dtype('float'))
@@ -1387,14 +3745,24 @@ class Index(Unit):
                     next_index = tf.stack(values=[next_index for _ in range(prev_dims)], axis=k)
                 index = tf.concat(values=(index, next_index), axis=(n + 1))
         index = tf.expand_dims(input=index, axis=0)
+        if channels_first(x):
+            index = tf.transpose(a=index, perm=(0, 3, 1, 2))
         multiples = [tf.shape(input=x)[0]] + [1] * (rank(x) - 1)
         index = tf.tile(input=index, multiples=multiples)
-        return tf.concat(values=(x, index), axis=(rank(x) - 1))
+        return tf.concat(values=(x, index), axis=channel_axis(x))
+
+    def compile_numpy(self, engine, x):
+        return engine.add('index', x)
+
+    def infer(self, x):
+        super(Index, self).forward(x)
+        x_shape = channels_last_shape(x)
+        return Symbol(shape=data_format_shape(x_shape[:-1] + (x_shape[-1] + rank(x) - 2,)), dtype=x.dtype)
 
 
 class Dense(Layer):
 
-    def __init__(self, size, bias=True, normalization='instance', activation='tanh', dropout=False, gated=False, norm_act_drop_before=False, name=None):
+    def __init__(self, size, bias=True, normalization='instance', activation='tanh', dropout=False, gated=False, pruning=None, norm_act_drop_before=False, name=None):
         super(Dense, self).__init__(size=size, name=name)
         assert isinstance(bias, bool)
         assert not normalization or Normalization.valid(normalization)
@@ -1408,6 +3776,7 @@ class Dense(Layer):
         self.activation = activation
         self.dropout = dropout
         self.gated = gated
+        self.pruning = None if pruning is None else Pruning(sparsity=pruning)
         self.norm_act_drop_before = norm_act_drop_before
 
     def initialize(self, x):
@@ -1434,30 +3803,36 @@ class Dense(Layer):
                 x >>= self.dropout
         if rank(x) == 2:
             self.weights.specify_shape(shape=(shape(x)[-1], self.size))
-            x = tf.matmul(a=x, b=self.weights())
+            if self.pruning is None:
+                x = tf.matmul(a=x, b=self.weights())
+            else:
+                x = self.pruning.matmul(x=x, weights=self.pruning.apply(weights=self.weights()))
             if self.gated:
                 self.gate_weights.specify_shape(shape=(shape(x)[-1], self.size))
                 gate = tf.matmul(a=x, b=self.gate_weights())
         elif rank(x) == 3:
             self.weights.specify_shape(shape=(1, shape(x)[-1], self.size))
-            x = tf.nn.conv1d(value=x, filters=self.weights(), stride=1, padding='SAME')
+            weights = self.weights() if self.pruning is None else self.pruning.apply(weights=self.weights())
+            x = tf.nn.conv1d(value=x, filters=weights, stride=1, padding='SAME')
             if self.gated:
                 self.gate_weights.specify_shape(shape=(1, shape(x)[-1], self.size))
                 gate = tf.nn.conv1d(value=x, filters=self.gate_weights(), stride=1, padding='SAME')
         elif rank(x) == 4:
-            self.weights.specify_shape(shape=(1, 1, shape(x)[-1], self.size))
-            x = tf.nn.conv2d(input=x, filter=self.weights(), strides=(1, 1, 1, 1), padding='SAME')
+            self.weights.specify_shape(shape=(1, 1, num_channels(x), self.size))
+            weights = self.weights() if self.pruning is None else self.pruning.apply(weights=self.weights())
+            x = tf.nn.conv2d(input=x, filter=weights, strides=(1, 1, 1, 1), padding='SAME', data_format=data_format(x))
             if self.gated:
-                self.gate_weights.specify_shape(shape=(1, 1, shape(x)[-1], self.size))
-                gate = tf.nn.conv2d(input=x, filter=self.gate_weights(), strides=(1, 1, 1, 1), padding='SAME')
+                self.gate_weights.specify_shape(shape=(1, 1, num_channels(x), self.size))
+                gate = tf.nn.conv2d(input=x, filter=self.gate_weights(), strides=(1, 1, 1, 1), padding='SAME', data_format=data_format(x))
+        axis = channel_axis(x)
         if self.bias is not None:
-            x = tf.nn.bias_add(value=x, bias=self.bias())
+            x = tf.nn.bias_add(value=x, bias=self.bias(), data_format=data_format(x))
             if self.gated:
-                gate = tf.nn.bias_add(value=gate, bias=self.gate_bias())
+                gate = tf.nn.bias_add(value=gate, bias=self.gate_bias(), data_format=data_format(gate))
         if self.squeeze:
-            x = tf.squeeze(input=x, axis=-1)
+            x = tf.squeeze(input=x, axis=axis)
             if self.gated:
-                gate = tf.squeeze(input=gate, axis=-1)
+                gate = tf.squeeze(input=gate, axis=axis)
         if not self.norm_act_drop_before:
             if self.normalization is not None:
                 x >>= self.normalization
@@ -1469,24 +3844,106 @@ class Dense(Layer):
             x *= (gate >> self.gate_activation)
         return x
 
+    def compile_numpy(self, engine, x):
+        transforms = [unit for unit in (self.normalization, self.activation, self.dropout) if unit is not None]
+        if self.norm_act_drop_before:
+            for unit in transforms:
+                x = engine.call(unit=unit, xs=x)
+        weights = engine.value(variable=self.weights)
+        if self.pruning is not None:
+            weights = weights * engine.value(variable=self.pruning.mask)
+        x = engine.add('matmul', x, weights=np.reshape(weights, (-1, self.size)))
+        if self.gated:
+            gate = engine.add('matmul', x, weights=np.reshape(engine.value(variable=self.gate_weights), (-1, self.size)))
+        if self.bias is not None:
+            x = engine.add('bias_add', x, bias=engine.value(variable=self.bias))
+            if self.gated:
+                gate = engine.add('bias_add', gate, bias=engine.value(variable=self.gate_bias))
+        if self.squeeze:
+            x = engine.add('squeeze', x)
+            if self.gated:
+                gate = engine.add('squeeze', gate)
+        if not self.norm_act_drop_before:
+            for unit in transforms:
+                x = engine.call(unit=unit, xs=x)
+        if self.gated:
+            x = engine.add('multiply', x, engine.call(unit=self.gate_activation, xs=gate))
+        return x
+
+    def infer(self, x):
+        super(Dense, self).forward(x)
+        assert 2 <= rank(x) <= 4
+        if self.norm_act_drop_before:
+            if self.normalization is not None:
+                x >>= self.normalization
+            if self.activation is not None:
+                x >>= self.activation
+            if self.dropout is not None:
+                x >>= self.dropout
+        self.weights.specify_shape(shape=(tuple(1 for _ in range(rank(x) - 2)) + (num_channels(x), self.size)))
+        weights = self.weights()
+        if self.pruning is not None:
+            self.pruning.register(weights=weights)
+        if self.gated:
+            # as in forward, the gate is computed from the transformed input
+            self.gate_weights.specify_shape(shape=(tuple(1 for _ in range(rank(x) - 2)) + (self.size, self.size)))
+            self.gate_weights()
+        if self.bias is not None:
+            self.bias()
+            if self.gated:
+                self.gate_bias()
+        x_shape = channels_last_shape(x)
+        x = Symbol(shape=(x_shape[:-1] if self.squeeze else data_format_shape(x_shape[:-1] + (self.size,))), dtype=x.dtype)
+        if self.gated:
+            gate = Symbol(shape=shape(x), dtype=x.dtype)
+        if not self.norm_act_drop_before:
+            if self.normalization is not None:
+                x >>= self.normalization
+            if self.activation is not None:
+                x >>= self.activation
+            if self.dropout is not None:
+                x >>= self.dropout
+        if self.gated:
+            gate >>= self.gate_activation
+            x = Symbol(shape=shape(x), dtype=x.dtype)
+        return x
+
+    def num_flops(self, xs, ys):
+        num_flops = 2 * num_channels(xs[0]) * num_elements(ys[0])
+        if self.bias is not None:
+            num_flops += num_elements(ys[0])
+        if self.gated:
+            num_flops += (2 * self.size + 2) * num_elements(ys[0])
+        return num_flops
+
 
 class Convolution(Layer):
 
     num_in = 1
     num_out = 1
 
-    def __init__(self, size, index=False, window=(3, 3), stride=1, padding='SAME', transposed=False, bias=True, normalization='instance', activation='relu', dropout=False, norm_act_drop_before=False, name=None):  # gated???????????????????????????????????????????????????????????
+    def __init__(self, size, index=False, window=(3, 3), stride=1, dilation=1, padding='SAME', transposed=False, groups=1, separable=False, bias=True, normalization='instance', activation='relu', dropout=False, norm_act_drop_before=False, name=None):  # gated???????????????????????????????????????????????????????????
         super(Convolution, self).__init__(size=size, name=name)
         window = (window,) if isinstance(window, int) else tuple(window)
         if isinstance(stride, int):
             stride = (stride,) if len(window) == 1 else (stride, stride)
         else:
             stride = (stride[0], stride[1])
+        if isinstance(dilation, int):
+            dilation = (dilation,) if len(window) == 1 else (dilation, dilation)
+        else:
+            dilation = (dilation[0], dilation[1])
         assert isinstance(index, bool)
         assert 1 <= len(window) <= 2 and all(isinstance(n, int) and n > 0 for n in window)
         assert len(stride) == len(window) and all(isinstance(n, int) and n > 0 for n in stride)
+        assert len(dilation) == len(window) and all(isinstance(n, int) and n > 0 for n in dilation)
+        # dilated kernels only support unit strides
+        assert all(n == 1 for n in stride) or all(n == 1 for n in dilation)
         assert padding in ('SAME', 'VALID')
-        assert isinstance(transposed, bool) and (not transposed or len(window) == 2)
+        assert isinstance(transposed, bool) and (not transposed or (len(window) == 2 and all(n == 1 for n in dilation)))
+        assert isinstance(groups, int) and groups > 0 and (groups == 1 or not transposed)
+        assert isinstance(separable, bool) and (not separable or (len(window) == 2 and not transposed and groups == 1))
+        assert size % groups == 0
         assert isinstance(bias, bool)
         assert not normalization or Normalization.valid(normalization)
         assert not activation or Activation.valid(activation)
@@ -1495,32 +3952,49 @@ class Convolution(Layer):
         self.index = index
         self.window = window
         self.stride = stride
+        self.dilation = dilation
         self.padding = padding
         self.transposed = transposed
+        self.groups = groups
+        self.separable = separable
         self.bias = bias
         self.normalization = normalization
         self.activation = activation
         self.dropout = dropout
         self.norm_act_drop_before = norm_act_drop_before
+        self.pointwise_filters = None
 
     def initialize(self, x):
         super(Convolution, self).initialize(x)
         if self.index:
             self.index = Index()
-            input_size = shape(x)[-1] + rank(x) - 2
+            input_size = num_channels(x) + rank(x) - 2
         else:
             self.index = None
-            input_size = shape(x)[-1]
+            input_size = num_channels(x)
+        assert input_size % self.groups == 0
         if self.transposed:
             filters_shape = self.window + (self.size, input_size)
+        elif self.separable:
+            # depthwise filters per input channel, followed by a pointwise 1x1 convolution
+            filters_shape = self.window + (input_size, 1)
+            self.pointwise_filters = Variable(name='pointwise_filters', shape=(1, 1, input_size, self.size), init=(self.activation or 'in-out'))
         else:
-            filters_shape = self.window + (input_size, self.size)
+            filters_shape = self.window + (input_size // self.groups, self.size)
         self.filters = Variable(name='filters', shape=filters_shape, init=(self.activation or 'in-out'))
         self.bias = Variable(name='bias', shape=(self.size,), init='zeros') if self.bias else None
         self.normalization = Normalization(normalization=self.normalization) if self.normalization else None
         self.activation = Activation(activation=self.activation) if self.activation else None
         self.dropout = Dropout() if self.dropout else None
 
+    def convolve(self, x, filters):
+        if any(n > 1 for n in self.dilation):
+            return tf.nn.convolution(input=x, filter=filters, padding=self.padding, dilation_rate=self.dilation, data_format=(data_format(x) if rank(x) == 4 else None))
+        elif len(self.window) == 1:
+            return tf.nn.conv1d(value=x, filters=filters, stride=self.stride[0], padding=self.padding)
+        else:
+            return tf.nn.conv2d(input=x, filter=filters, strides=data_format_strides(x=x, stride=self.stride), padding=self.padding, data_format=data_format(x))
+
     def forward(self, x):
         super(Convolution, self).forward(x)
         if self.norm_act_drop_before:
@@ -1532,17 +4006,81 @@ class Convolution(Layer):
                 x >>= self.dropout
         if self.index is not None:
             x >>= self.index
-        if len(self.window) == 1:
-            x = tf.nn.conv1d(value=x, filters=self.filters(), stride=self.stride[0], padding=self.padding)
+        if self.groups > 1:
+            axis = channel_axis(x)
+            filters = tf.split(value=self.filters(), num_or_size_splits=self.groups, axis=-1)
+            xs = tf.split(value=x, num_or_size_splits=self.groups, axis=axis)
+            x = tf.concat(values=[self.convolve(x=x, filters=f) for x, f in zip(xs, filters)], axis=axis)
+        elif self.separable:
+            x = tf.nn.separable_conv2d(input=x, depthwise_filter=self.filters(), pointwise_filter=self.pointwise_filters(), strides=data_format_strides(x=x, stride=self.stride), padding=self.padding, rate=self.dilation, data_format=data_format(x))
         elif self.transposed:
-            batch, height, width, _ = shape(x)
-            x = tf.nn.conv2d_transpose(value=x, filter=self.filters(), output_shape=(batch, height * self.stride[1], width * self.stride[2], self.size), strides=((1,) + self.stride + (1,)), padding=self.padding)
+            _, height, width, _ = channels_last_shape(x)
+            output_shape = data_format_shape((tf.shape(input=x)[0], height * self.stride[0], width * self.stride[1], self.size))
+            x = tf.nn.conv2d_transpose(value=x, filter=self.filters(), output_shape=output_shape, strides=data_format_strides(x=x, stride=self.stride), padding=self.padding, data_format=data_format(x))
+        else:
+            x = self.convolve(x=x, filters=self.filters())
+        axis = channel_axis(x)
+        if self.bias is not None:
+            x = tf.nn.bias_add(value=x, bias=self.bias(), data_format=data_format(x))
+        if self.squeeze:
+            x = tf.squeeze(input=x, axis=axis)
+        if not self.norm_act_drop_before:
+            if self.normalization is not None:
+                x >>= self.normalization
+            if self.activation is not None:
+                x >>= self.activation
+            if self.dropout is not None:
+                x >>= self.dropout
+        return x
+
+    def compile_numpy(self, engine, x):
+        assert not self.transposed
+        transforms = [unit for unit in (self.normalization, self.activation, self.dropout) if unit is not None]
+        if self.norm_act_drop_before:
+            for unit in transforms:
+                x = engine.call(unit=unit, xs=x)
+        if self.index is not None:
+            x = engine.call(unit=self.index, xs=x)
+        filters = engine.value(variable=self.filters)
+        if self.separable:
+            x = engine.add('convolution', x, filters=filters, stride=self.stride, dilation=self.dilation, padding=self.padding, depthwise=True)
+            x = engine.add('matmul', x, weights=np.reshape(engine.value(variable=self.pointwise_filters), (-1, self.size)))
         else:
-            x = tf.nn.conv2d(input=x, filter=self.filters(), strides=((1,) + self.stride + (1,)), padding=self.padding)
+            x = engine.add('convolution', x, filters=filters, stride=self.stride, dilation=self.dilation, padding=self.padding, groups=self.groups)
         if self.bias is not None:
-            x = tf.nn.bias_add(value=x, bias=self.bias())
+            x = engine.add('bias_add', x, bias=engine.value(variable=self.bias))
+        if self.squeeze:
+            x = engine.add('squeeze', x)
+        if not self.norm_act_drop_before:
+            for unit in transforms:
+                x = engine.call(unit=unit, xs=x)
+        return x
+
+    def infer(self, x):
+        super(Convolution, self).forward(x)
+        if self.norm_act_drop_before:
+            if self.normalization is not None:
+                x >>= self.normalization
+            if self.activation is not None:
+                x >>= self.activation
+            if self.dropout is not None:
+                x >>= self.dropout
+        if self.index is not None:
+            x >>= self.index
+        self.filters()
+        if self.pointwise_filters is not None:
+            self.pointwise_filters()
+        if self.bias is not None:
+            self.bias()
+        x_shape = channels_last_shape(x)
+        if self.transposed:
+            convolved_shape = tuple(-1 if dims == -1 else dims * stride for dims, stride in zip(x_shape[1:-1], self.stride))
+        else:
+            convolved_shape = tuple(strided_dims(dims=dims, window=((window - 1) * dilation + 1), stride=stride, padding=self.padding) for dims, window, stride, dilation in zip(x_shape[1:-1], self.window, self.stride, self.dilation))
         if self.squeeze:
-            x = tf.squeeze(input=x, axis=-1)
+            x = Symbol(shape=(x_shape[:1] + convolved_shape), dtype=x.dtype)
+        else:
+            x = Symbol(shape=data_format_shape(x_shape[:1] + convolved_shape + (self.size,)), dtype=x.dtype)
         if not self.norm_act_drop_before:
             if self.normalization is not None:
                 x >>= self.normalization
@@ -1552,6 +4090,18 @@ class Convolution(Layer):
                 x >>= self.dropout
         return x
 
+    def num_flops(self, xs, ys):
+        if self.transposed:
+            positions = num_elements(xs[0]) // num_channels(xs[0])
+        else:
+            positions = num_elements(ys[0]) // self.size
+        num_flops = 2 * product(self.filters.shape) * positions
+        if self.pointwise_filters is not None:
+            num_flops += 2 * product(self.pointwise_filters.shape) * positions
+        if self.bias is not None:
+            num_flops += num_elements(ys[0])
+        return num_flops
+
 
 # class ConditionedConvolution(Unit):
 
@@ -1680,9 +4230,20 @@ class NgramConvolution(Layer):
         # maybe lstm?
         return tf.concat(values=embeddings, axis=1)
 
+    def infer(self, x):
+        super(NgramConvolution, self).forward(x)
+        embeddings = [x >> convolution for convolution in self.convolutions]
+        shapes = [shape(embedding)[:-1] if self.squeeze else shape(embedding) for embedding in embeddings]
+        length = product_dims(s[1] for s in shapes)
+        if length != -1:
+            length = sum(s[1] for s in shapes)
+        return Symbol(shape=(shapes[0][:1] + (length,) + shapes[0][2:]), dtype=x.dtype)
+
 
 class RnnCell(Layer):
 
+    num_gates = 1
+
     @staticmethod
     def valid(cell):
         return cell in ('gru', 'lstm', 'simple')
@@ -1730,6 +4291,8 @@ class RnnCell(Layer):
         self.cell = cell
         if self.initial_state_variable:
             self.initial_state = Variable(name='init', shape=self.initial_state_shape, dtype='float')
+        elif Model.current.dry_run:
+            self.initial_state = None
         else:
             self.initial_state = tf.zeros(shape=self.initial_state_shape, dtype=Model.dtype('float'))
 
@@ -1766,6 +4329,7 @@ class Lstm(RnnCell):
 
     num_in = 2
     num_out = 2
+    num_gates = 4
 
     @classmethod
     def size_from_state_size(state_size):
@@ -1776,7 +4340,7 @@ class Lstm(RnnCell):
         super(Lstm, self).__init__(size=size, initial_state_shape=(2, size), initial_state_variable=initial_state_variable, name=name)
 
     def initialize(self, x):
-        lstm = tf.contrib.rnn.LSTMCell(num_units=self.size)
+        lstm = None if Model.current.dry_run else tf.contrib.rnn.LSTMCell(num_units=self.size)
         super(Lstm, self).initialize(x, lstm)
 
     def get_initial_state(self, batch_size):
@@ -1791,9 +4355,10 @@ class Gru(RnnCell):
 
     num_in = 2
     num_out = 2
+    num_gates = 3
 
     def initialize(self, x):
-        gru = tf.contrib.rnn.GRUCell(num_units=self.size)
+        gru = None if Model.current.dry_run else tf.contrib.rnn.GRUCell(num_units=self.size)
         super(Gru, self).initialize(x, gru)
 
 
@@ -1831,6 +4396,30 @@ class Rnn(Layer):
         state = self.cell.get_final_state(state=state)
         return x, state
 
+    def compile_numpy(self, engine, x, length=None):
+        assert isinstance(self.cell, (Lstm, Gru))
+        cell = 'lstm' if isinstance(self.cell, Lstm) else 'gru'
+        weights = tuple(engine.value(variable=variable) for variable in self.cell.get_cell().weights)
+        if self.initial_state_variable:
+            initial_state = engine.value(variable=self.cell.initial_state)
+        else:
+            initial_state = np.zeros(shape=self.cell.initial_state_shape, dtype=np.float32)
+        xs = (x,) if length is None else (x, length)
+        return engine.add('rnn', *xs, num_out=2, cell=cell, weights=weights, initial_state=initial_state)
+
+    def infer(self, x, length=None):
+        super(Rnn, self).forward(x, length)
+        if self.initial_state_variable:
+            self.cell.initial_state()
+        state_size = product(self.cell.initial_state_shape[1:])
+        return Symbol(shape=(shape(x)[:-1] + (self.size,)), dtype=x.dtype), Symbol(shape=(shape(x)[0], state_size), dtype=x.dtype)
+
+    def num_flops(self, xs, ys):
+        input_size = shape(xs[0])[-1]
+        num_steps = num_elements(xs[0]) // input_size
+        num_gates = self.cell.num_gates
+        return num_steps * (2 * (input_size + self.size) * num_gates * self.size + 4 * num_gates * self.size)
+
 
 # class Expand(Layer):
 
@@ -1879,45 +4468,67 @@ class Repeat(LayerStack):
 
 class ConvolutionalNet(LayerStack):
 
-    def __init__(self, sizes, depths, pool='max', name=None):
+    def __init__(self, sizes, depths, layer=Convolution, pool='max', dilations=None, name=None):
         super(LayerStack, self).__init__(name=name)
-        assert Pooling.valid(pool)
+        assert issubclass(layer, Layer)
+        # pool='stride' downsamples with the first convolution of each stage instead of a Pooling unit
+        assert Pooling.valid(pool) or pool == 'stride'
+        assert dilations is None or (len(dilations) == len(sizes) and all(isinstance(n, int) and n > 0 for n in dilations))
         self.sizes = sizes
         self.depths = depths
+        self.layer = layer
         self.pool = pool
+        self.dilations = dilations
 
     def initialize(self, x):
         super(ConvolutionalNet, self).initialize(x)
-        for m, (size, depth) in enumerate(zip(self.sizes, self.depths)):
-            if m > 0:
+        dilations = self.dilations or tuple(1 for _ in self.sizes)
+        for m, (size, depth, dilation) in enumerate(zip(self.sizes, self.depths, dilations)):
+            if m > 0 and self.pool != 'stride':
                 self.layers.append(Pooling(pool=self.pool))
             for n in range(depth):
-                self.layers.append(Convolution(size=size))
+                if m > 0 and n == 0 and self.pool == 'stride':
+                    self.layers.append(self.layer(size=size, stride=2))
+                elif dilation > 1:
+                    self.layers.append(self.layer(size=size, dilation=dilation))
+                else:
+                    self.layers.append(self.layer(size=size))
 
 
 class Residual(Layer):
 
-    def __init__(self, size, unit=Convolution, depth=2, transform=True, reduction='sum', name=None):
+    def __init__(self, size, unit=Convolution, depth=2, transform=True, reduction='sum', stride=1, dilation=1, name=None):
         super(Residual, self).__init__(size=size, name=name)
         assert isinstance(depth, int) and depth > 0
         assert not self.squeeze or depth == 1
-        assert isinstance(transform, (bool, Layer))
+        assert isinstance(transform, bool) or callable(transform)
+        assert isinstance(stride, int) and stride > 0
+        assert isinstance(dilation, int) and dilation > 0
         self.unit = unit
         self.depth = depth
         self.transform = transform
         self.reduction = reduction
+        self.stride = stride
+        self.dilation = dilation
 
     def initialize(self, x):
         super(Residual, self).initialize(x)
         self.units = list()
-        for _ in range(self.depth):
-            self.units.append(self.unit(size=self.size))
-        if shape(x)[-1] == self.size:
+        for n in range(self.depth):
+            if n == 0 and self.stride > 1:
+                self.units.append(self.unit(size=self.size, stride=self.stride))
+            elif self.dilation > 1:
+                self.units.append(self.unit(size=self.size, dilation=self.dilation))
+            else:
+                self.units.append(self.unit(size=self.size))
+        transform = self.unit if isinstance(self.transform, bool) else self.transform
+        if num_channels(x) == self.size and self.stride == 1:
             self.transform = None
-        elif isinstance(self.transform, Layer):
-            self.transform = self.transform(size=self.size)
+        elif self.stride > 1:
+            # the shortcut is strided like the first unit
+            self.transform = transform(size=self.size, stride=self.stride)
         else:
-            self.transform = self.unit(size=self.size)
+            self.transform = transform(size=self.size)
         self.reduction = Reduction(reduction=self.reduction)
 
     def forward(self, x):
@@ -1930,34 +4541,49 @@ class Residual(Layer):
         assert shape(x) == shape(res)
         return (x, res) >> self.reduction
 
+    def compile_numpy(self, engine, x):
+        res = x
+        for unit in self.units:
+            res = engine.call(unit=unit, xs=res)
+        if self.transform is not None:
+            x = engine.call(unit=self.transform, xs=x)
+        return engine.call(unit=self.reduction, xs=(x, res))
+
 
 class ResidualNet(LayerStack):
 
     # citation!
 
-    def __init__(self, sizes, depths, layer=Convolution, transition=None, pool='max', name=None):
+    def __init__(self, sizes, depths, layer=Convolution, transition=None, pool='max', dilations=None, name=None):
         super(LayerStack, self).__init__(name=name)
-        assert Pooling.valid(pool)
+        assert Pooling.valid(pool) or pool == 'stride'
+        assert dilations is None or (len(dilations) == len(sizes) and all(isinstance(n, int) and n > 0 for n in dilations))
         self.sizes = sizes
         self.depths = depths
         self.layer = layer
         self.transition = transition
         self.pool = pool
+        self.dilations = dilations
 
     def initialize(self, x):
         super(ResidualNet, self).initialize(x)
-        for m, (size, depth) in enumerate(zip(self.sizes, self.depths)):
-            if m > 0:
+        dilations = self.dilations or tuple(1 for _ in self.sizes)
+        for m, (size, depth, dilation) in enumerate(zip(self.sizes, self.depths, dilations)):
+            if m > 0 and self.pool != 'stride':
                 self.layers.append(Pooling(pool=self.pool))
             # if transition:
             #     layers.append(transition(size=size, normalize=False, activation))
             for n in range(depth):
                 if m == 0:
                     if n == 0:
-                        self.layers.append(self.layer(size=size, normalization=False, activation=None))
-                        layer = (lambda size: self.layer(size=size, norm_act_drop_before=True))  # pre activation
+                        # the first stage is the stem layer, dilated like the later stages if requested
+                        kwargs = dict(dilation=dilation) if dilation > 1 else dict()
+                        self.layers.append(self.layer(size=size, normalization=False, activation=None, **kwargs))
+                        layer = (lambda size, **kwargs: self.layer(size=size, norm_act_drop_before=True, **kwargs))  # pre activation
+                elif n == 0 and self.pool == 'stride':
+                    self.layers.append(Residual(size=size, unit=layer, stride=2))
                 else:
-                    self.layers.append(Residual(size=size, unit=layer))
+                    self.layers.append(Residual(size=size, unit=layer, dilation=dilation))
         self.layers.append(Normalization(normalization='instance'))
         self.layers.append(Activation(activation='relu'))
 
@@ -1988,6 +4614,13 @@ class Fractal(Layer):
         x >>= self.unit
         return (x, y) >> self.reduction
 
+    def compile_numpy(self, engine, x):
+        if self.depth == 0:
+            return engine.call(unit=self.unit, xs=x)
+        y = engine.call(unit=self.ffx, xs=engine.call(unit=self.fx, xs=x))
+        x = engine.call(unit=self.unit, xs=x)
+        return engine.call(unit=self.reduction, xs=(x, y))
+
 
 class FractalNet(LayerStack):
 